@@ -1,3 +1,4 @@
-from .base import Client
+from .base import Client, ChatCompletionsClient, bypass_cache
 from .openai_client import OpenAIChatClient
 from .azure_client import AzureChatClient
+from .openai_batch_client import OpenAIBatchClient
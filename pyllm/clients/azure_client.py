@@ -1,17 +1,13 @@
 import os
-import requests
-import json
 
-from typing import Dict, Optional
-from dataclasses import asdict
+from typing import Optional
 
-from pyllm.clients import Client
-from pyllm.utils.types import SamplingParams
+from pyllm.clients import ChatCompletionsClient
 from pyllm.utils.registry import CLIENT_REGISTRY
 
 
 @CLIENT_REGISTRY.register("azure")
-class AzureChatClient(Client):
+class AzureChatClient(ChatCompletionsClient):
     """
     A client for querying an OpenAI API endpoint hosted on Azure, specifically designed for chat completions.
 
@@ -28,6 +24,10 @@ class AzureChatClient(Client):
         deployment_id: Optional[str] = None,
         api_version: Optional[str] = None,
         api_key: Optional[str] = None,
+        max_connections: int = 32,
+        http2: bool = True,
+        cache: bool = False,
+        max_retries: int = 5,
     ):
         if api_key is not None:
             self.api_key = api_key
@@ -52,41 +52,12 @@ class AzureChatClient(Client):
             self.url = f"https://{resource_name}.openai.azure.com/openai/deployments/{deployment_id}/chat/completions?api-version={api_version}"
 
         self.model_name = self.url
-
-    def query(
-        self,
-        prompt: Optional[str] = None,
-        messages: Optional[Dict] = None,
-        sampling_params: SamplingParams = SamplingParams(),
-    ) -> str:
-        """
-        Queries the OpenAI API endpoint with a given prompt and sampling parameters.
-
-        Args:
-            prompt (str): The prompt to send to the model.
-            params (SamplingParams): An instance of SamplingParams specifying parameters
-                for the query, such as temperature, max tokens, etc.
-
-        Returns:
-            str: The content of the message returned by the model as a response to the query.
-
-        Raises:
-            requests.RequestException: If the request to the OpenAI API fails or returns a
-                non-200 status code, with the response content included in the exception message.
-        """
-        if (not prompt and not messages) or (prompt and messages):
-            raise ValueError("Pass either a string prompt or messages dict")
-
-        headers = {"api-key": f"{self.api_key}"}
-
-        body = {
-            "messages": messages if messages else [{"role": "user", "content": prompt}],
-            **asdict(sampling_params),
-        }
-
-        res = requests.post(self.url, json=body, headers=headers)
-
-        if res.status_code != 200:
-            raise requests.RequestException(res.content)
-
-        return json.loads(res.content)["choices"][0]["message"]["content"]
+        self.completions_url = self.url
+
+        super().__init__(
+            {"api-key": f"{self.api_key}"},
+            max_connections=max_connections,
+            http2=http2,
+            cache=cache,
+            max_retries=max_retries,
+        )
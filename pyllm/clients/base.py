@@ -1,4 +1,53 @@
-from pyllm.utils.types import SamplingParams
+import random
+import asyncio
+import contextlib
+import contextvars
+import functools
+import httpx
+import orjson
+import requests
+import urllib.parse
+
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+from pyllm.clients.cache import ResponseCache
+from pyllm.utils.concurrency import RateLimitGate, SingleFlight
+from pyllm.utils.types import SamplingParams, sampling_params_dict
+
+# Rate limiting and transient server errors, which are worth retrying
+_RETRY_STATUSES = (429, 500, 502, 503, 504)
+_BACKOFF_FACTOR_S = 0.5
+# Long enough for slow generations, as the read timeout applies between chunks of the
+# response, which only arrive once generation is done unless it is streamed
+_CONNECT_TIMEOUT_S = 10
+_READ_TIMEOUT_S = 600
+
+# Unset by `bypass_cache` for the queries made within it, on this thread or task
+_USE_CACHE = contextvars.ContextVar("use_cache", default=True)
+
+
+@contextlib.contextmanager
+def bypass_cache(bypass: bool = True):
+    """
+    Makes the queries made within the context skip the response cache of the clients
+    that have one, neither reading nor writing it, so that every response is fresh.
+    Does nothing if `bypass` is False.
+    """
+    token = _USE_CACHE.set(_USE_CACHE.get() and not bypass)
+    try:
+        yield
+    finally:
+        _USE_CACHE.reset(token)
+
+
+@functools.lru_cache(maxsize=8)
+def _sampling_params_fragment(sampling_params: SamplingParams) -> bytes:
+    # The serialized fields without the enclosing braces, to be spliced into bodies
+    return orjson.dumps(dict(sampling_params_dict(sampling_params)))[1:-1]
 
 
 class Client:
@@ -41,3 +90,522 @@ class Client:
             "Client's querying capability has not been implemented yet for",
             self.__class__.__name__,
         )
+
+    def query_stream(self, *args, **kwargs) -> Iterator[str]:
+        """
+        Streaming counterpart of `query`, taking the same arguments.
+
+        By default, the whole response of `query` is yielded as a single chunk.
+        Subclasses that can receive a response incrementally should override this
+        method to yield chunks as they arrive.
+
+        Yields:
+            str: Consecutive chunks of the response, which concatenate to the full response.
+        """
+        yield self.query(*args, **kwargs)
+
+    async def aquery(self, *args, **kwargs) -> str:
+        """
+        Asynchronous counterpart of `query`, taking the same arguments.
+
+        By default, the synchronous `query` is run in the event loop's default executor
+        so that any client can be awaited. Subclasses that can talk to their model
+        natively without blocking should override this method.
+
+        Returns:
+            str: The response from the model as a string.
+        """
+        loop = asyncio.get_running_loop()
+        # The executor doesn't carry over the context, such as `bypass_cache`
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(
+            None, functools.partial(context.run, self.query, *args, **kwargs)
+        )
+
+    async def aquery_stream(self, *args, **kwargs) -> AsyncIterator[str]:
+        """
+        Asynchronous counterpart of `query_stream`, taking the same arguments.
+
+        By default, the whole response of `aquery` is yielded as a single chunk.
+        """
+        yield await self.aquery(*args, **kwargs)
+
+    def warmup(self, n: int = 1):
+        """
+        Opens up to `n` connections ahead of the first queries, so that they don't pay
+        for connection setup. Does nothing by default.
+        """
+
+    async def awarmup(self, n: int = 1):
+        """
+        Asynchronous counterpart of `warmup`, preparing connections for `aquery`.
+        """
+
+    async def arelease(self):
+        """
+        Releases anything bound to the running event loop, such as connections opened by
+        `aquery`, before the loop is closed. Does nothing by default.
+        """
+
+
+class ChatCompletionsClient(Client):
+    """
+    A base class for clients that query an OpenAI-compatible chat completions endpoint over HTTP.
+
+    All requests go through a single pooled `requests.Session`, so keep-alive connections
+    (and their TCP and TLS handshakes) are reused across queries instead of being opened
+    anew for every call.
+
+    Requests that are rate limited or hit a transient server error are retried with
+    exponential backoff, honoring the server's `Retry-After` header. When the server
+    reports that no requests are left in its rate limit window, queries wait for the
+    window to reset before being sent.
+
+    Attributes:
+        completions_url (str): The full URL of the chat completions endpoint.
+        warmup_url (str): The URL requested by `warmup` to open connections. Defaults to
+            the root of the server `completions_url` is on, so that no generation is
+            requested.
+    """
+
+    completions_url: str
+
+    @property
+    def warmup_url(self) -> str:
+        url = urllib.parse.urlsplit(self.completions_url)
+        return urllib.parse.urlunsplit((url.scheme, url.netloc, "/", "", ""))
+
+    def __init__(
+        self,
+        headers: Dict[str, str],
+        max_connections: int = 32,
+        http2: bool = True,
+        cache: bool = False,
+        max_retries: int = 5,
+    ):
+        """
+        Args:
+            headers (Dict[str, str]): Headers sent with every request, typically used for
+                authentication.
+            max_connections (int): The maximum number of keep-alive connections kept in
+                the pool. Should be at least the number of concurrent queries, or extra
+                connections will be opened and closed for every query beyond it.
+            http2 (bool): Whether asynchronous queries may use HTTP/2, multiplexing all
+                concurrent queries over a single connection. Servers that do not support
+                it are transparently spoken to over HTTP/1.1.
+            cache (bool): Whether to cache responses, so that repeating a request with the
+                same messages and sampling parameters skips the network round-trip.
+                Responses sampled with a temperature of 0 are cached whatever their
+                seed.
+            max_retries (int): The maximum number of times a request is retried after
+                being rate limited or failing with a transient server error.
+        """
+        self.cache = cache
+        self.max_retries = max_retries
+        self.response_cache = ResponseCache.shared()
+        self._inflight = SingleFlight()
+        self._rate_limit = RateLimitGate()
+
+        # Bodies are serialized with orjson rather than through the `json=` argument
+        self._headers = {**headers, "Content-Type": "application/json"}
+        self._max_connections = max_connections
+        self._http2 = http2
+        self._aclient: Optional[httpx.AsyncClient] = None
+        self._aclient_loop: Optional[asyncio.AbstractEventLoop] = None
+
+        self._session = requests.Session()
+        # Threads beyond the pool size open extra connections rather than block
+        adapter = HTTPAdapter(
+            pool_connections=max_connections,
+            pool_maxsize=max_connections,
+            pool_block=False,
+            max_retries=Retry(
+                total=max_retries,
+                backoff_factor=_BACKOFF_FACTOR_S,
+                status_forcelist=_RETRY_STATUSES,
+                allowed_methods=["POST"],
+                respect_retry_after_header=True,
+                # The last response is returned so that its error can be raised
+                raise_on_status=False,
+            ),
+        )
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self._session.headers.update(self._headers)
+
+        self._body_prefix_memo: Optional[Tuple[Dict, bytes]] = None
+
+    def _body_fields(self) -> Dict:
+        # Fields sent with every request, regardless of the messages and parameters
+        return {}
+
+    def _build_body(self, messages: Dict, sampling_params: SamplingParams) -> Dict:
+        return {
+            **self._body_fields(),
+            "messages": messages,
+            **sampling_params_dict(sampling_params),
+        }
+
+    def _body_prefix(self) -> bytes:
+        # Serialized again only when the fields change, e.g. with `model_name`
+        fields = self._body_fields()
+        if self._body_prefix_memo is None or self._body_prefix_memo[0] != fields:
+            prefix = b"{" + orjson.dumps(fields)[1:-1]
+            if len(prefix) > 1:
+                prefix += b","
+            self._body_prefix_memo = (fields, prefix)
+        return self._body_prefix_memo[1]
+
+    def _dump_body(
+        self, messages: Dict, sampling_params: SamplingParams, stream: bool = False
+    ) -> bytes:
+        # Equivalent to serializing `_build_body`, but only the messages are serialized
+        # per request, while the rest of the body is spliced in from cached fragments
+        return b"".join(
+            (
+                self._body_prefix(),
+                b'"messages":',
+                orjson.dumps(messages),
+                b",",
+                _sampling_params_fragment(sampling_params),
+                b',"stream":true}' if stream else b"}",
+            )
+        )
+
+    def _build_messages(self, prompt: Optional[str], messages: Optional[Dict]) -> Dict:
+        if (not prompt and not messages) or (prompt and messages):
+            raise ValueError("Pass either a string prompt or messages dict")
+        return messages if messages else [{"role": "user", "content": prompt}]
+
+    def _cache_key(
+        self, messages: Dict, sampling_params: SamplingParams
+    ) -> Optional[str]:
+        if not self.cache or not _USE_CACHE.get():
+            return None
+        if sampling_params.temperature == 0:
+            # Greedy decoding is deterministic, so the response can be reused whatever
+            # the seed. This assumes `model_name` pins the version of the model.
+            sampling_params = replace(sampling_params, seed=None)
+        return self.response_cache.key(self.model_name, messages, sampling_params)
+
+    def _parse_response(self, status_code: int, content: bytes) -> str:
+        if status_code != 200:
+            raise requests.RequestException(content)
+
+        return orjson.loads(content)["choices"][0]["message"]["content"]
+
+    def query(
+        self,
+        prompt: Optional[str] = None,
+        messages: Optional[Dict] = None,
+        sampling_params: SamplingParams = SamplingParams(),
+    ) -> str:
+        """
+        Queries the chat completions endpoint with a given prompt and sampling parameters.
+
+        If the client was created with `cache=True`, cached responses are returned
+        without querying the endpoint, and concurrent identical queries are sent only
+        once, unless made within `bypass_cache`. Greedy responses are cached per
+        `model_name` whatever their seed, so the cache should be cleared when a model
+        name starts pointing to a new version of the model.
+
+        Args:
+            prompt (str): The prompt to send to the model.
+            messages (Dict): The messages to send to the model, used instead of the prompt.
+            params (SamplingParams): An instance of SamplingParams specifying parameters
+                for the query, such as temperature, max tokens, etc.
+
+        Returns:
+            str: The content of the message returned by the model as a response to the query.
+
+        Raises:
+            requests.RequestException: If the request to the API fails or returns a
+                non-200 status code, with the response content included in the exception message.
+        """
+        messages = self._build_messages(prompt, messages)
+        if (key := self._cache_key(messages, sampling_params)) is None:
+            return self._post(messages, sampling_params)
+
+        # Identical concurrent requests share a single response
+        return self._inflight.do(key, self._cached_post, key, messages, sampling_params)
+
+    def _cached_post(
+        self, key: str, messages: Dict, sampling_params: SamplingParams
+    ) -> str:
+        if (response := self.response_cache.get(key)) is not None:
+            return response
+
+        response = self._post(messages, sampling_params)
+        self.response_cache.set(key, response)
+        return response
+
+    def _post(self, messages: Dict, sampling_params: SamplingParams) -> str:
+        body = self._dump_body(messages, sampling_params)
+
+        self._rate_limit.pause()
+        res = self._session.post(
+            self.completions_url,
+            data=body,
+            timeout=(_CONNECT_TIMEOUT_S, _READ_TIMEOUT_S),
+        )
+        self._rate_limit.update(res.headers)
+
+        return self._parse_response(res.status_code, res.content)
+
+    def query_stream(
+        self,
+        prompt: Optional[str] = None,
+        messages: Optional[Dict] = None,
+        sampling_params: SamplingParams = SamplingParams(),
+    ) -> Iterator[str]:
+        """
+        Queries the chat completions endpoint like `query`, but yields the response in
+        chunks as the server sends them, so that callers can start processing it before
+        it is complete.
+
+        Closing the generator early closes the connection, aborting the generation. Only
+        responses that were streamed completely are cached.
+
+        Yields:
+            str: Consecutive chunks of the content of the message returned by the model.
+
+        Raises:
+            requests.RequestException: If the request to the API fails or returns a
+                non-200 status code, with the response content included in the exception message.
+        """
+        messages = self._build_messages(prompt, messages)
+        if (key := self._cache_key(messages, sampling_params)) is not None:
+            if (response := self.response_cache.get(key)) is not None:
+                yield response
+                return
+
+        body = self._dump_body(messages, sampling_params, stream=True)
+
+        chunks = []
+        self._rate_limit.pause()
+        with self._session.post(
+            self.completions_url,
+            data=body,
+            stream=True,
+            timeout=(_CONNECT_TIMEOUT_S, _READ_TIMEOUT_S),
+        ) as res:
+            self._rate_limit.update(res.headers)
+            if res.status_code != 200:
+                raise requests.RequestException(res.content)
+
+            for line in res.iter_lines():
+                if (event := self._parse_event(line.decode())) is None:
+                    break
+                for chunk in event:
+                    chunks.append(chunk)
+                    yield chunk
+
+        if key is not None:
+            self.response_cache.set(key, "".join(chunks))
+
+    async def aquery_stream(
+        self,
+        prompt: Optional[str] = None,
+        messages: Optional[Dict] = None,
+        sampling_params: SamplingParams = SamplingParams(),
+    ) -> AsyncIterator[str]:
+        """
+        Asynchronous counterpart of `query_stream`, streaming the response through the
+        same client as `aquery`. Closing the generator early aborts the generation.
+        """
+        messages = self._build_messages(prompt, messages)
+        if (key := self._cache_key(messages, sampling_params)) is not None:
+            if (response := self.response_cache.get(key)) is not None:
+                yield response
+                return
+
+        body = self._dump_body(messages, sampling_params, stream=True)
+
+        chunks = []
+        await self._rate_limit.apause()
+        async with self._get_async_client().stream(
+            "POST", self.completions_url, content=body
+        ) as res:
+            self._rate_limit.update(res.headers)
+            if res.status_code != 200:
+                raise requests.RequestException(await res.aread())
+
+            async for line in res.aiter_lines():
+                if (event := self._parse_event(line)) is None:
+                    break
+                for chunk in event:
+                    chunks.append(chunk)
+                    yield chunk
+
+        if key is not None:
+            self.response_cache.set(key, "".join(chunks))
+
+    def _parse_event(self, line: str) -> Optional[List[str]]:
+        # Server-sent events, one "data: <json>" line per chunk, returning the chunks of
+        # the first choice's content, or None once the stream is done
+        if not line.startswith("data: "):
+            return []
+        data = line[len("data: ") :]
+        if data == "[DONE]":
+            return None
+        return [
+            choice["delta"]["content"]
+            for choice in orjson.loads(data)["choices"]
+            if choice["index"] == 0 and choice["delta"].get("content")
+        ]
+
+    async def aquery(
+        self,
+        prompt: Optional[str] = None,
+        messages: Optional[Dict] = None,
+        sampling_params: SamplingParams = SamplingParams(),
+    ) -> str:
+        """
+        Asynchronously queries the chat completions endpoint, taking the same arguments
+        and raising the same errors as `query`. Rate limited requests, server errors and
+        transport failures, such as timeouts and dropped connections, are retried up to
+        `max_retries` times, after which transport failures are raised as
+        `requests.ConnectionError`.
+
+        Requests are sent through an `httpx.AsyncClient` that is created lazily for the
+        running event loop, so that many queries can be in flight on a single thread and,
+        over HTTP/2, on a single connection.
+        """
+        messages = self._build_messages(prompt, messages)
+        if (key := self._cache_key(messages, sampling_params)) is None:
+            return await self._apost(messages, sampling_params)
+
+        return await self._inflight.ado(
+            key, self._acached_post, key, messages, sampling_params
+        )
+
+    async def _acached_post(
+        self, key: str, messages: Dict, sampling_params: SamplingParams
+    ) -> str:
+        if (response := self.response_cache.get(key)) is not None:
+            return response
+
+        response = await self._apost(messages, sampling_params)
+        self.response_cache.set(key, response)
+        return response
+
+    async def _apost(self, messages: Dict, sampling_params: SamplingParams) -> str:
+        content = self._dump_body(messages, sampling_params)
+
+        # httpx only retries failed connections, so retries are handled here
+        for attempt in range(self.max_retries + 1):
+            await self._rate_limit.apause()
+            try:
+                res = await self._get_async_client().post(
+                    self.completions_url, content=content
+                )
+            except httpx.TransportError as e:
+                # Raised as the error `query` raises, so that callers catch either
+                if attempt == self.max_retries:
+                    raise requests.ConnectionError(f"{type(e).__name__}: {e}") from e
+                await asyncio.sleep(self._retry_delay(attempt, {}))
+                continue
+            self._rate_limit.update(res.headers)
+            if res.status_code not in _RETRY_STATUSES or attempt == self.max_retries:
+                break
+            await asyncio.sleep(self._retry_delay(attempt, res.headers))
+
+        return self._parse_response(res.status_code, res.content)
+
+    def _retry_delay(self, attempt: int, headers: Dict[str, str]) -> float:
+        retry_after = headers.get("retry-after")
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        # Jittered, so that queries rejected together don't all retry together
+        return random.uniform(0, _BACKOFF_FACTOR_S * 2**attempt)
+
+    def warmup(self, n: int = 1):
+        """
+        Opens `n` connections to the server with cheap concurrent requests, leaving them
+        in the pool for the first queries to reuse. Responses and errors are ignored.
+        """
+
+        def ping():
+            try:
+                self._session.get(
+                    self.warmup_url, timeout=(_CONNECT_TIMEOUT_S, _READ_TIMEOUT_S)
+                ).close()
+            except requests.RequestException:
+                pass
+
+        with ThreadPoolExecutor(n) as executor:
+            for _ in range(n):
+                executor.submit(ping)
+
+    async def awarmup(self, n: int = 1):
+        """
+        Asynchronous counterpart of `warmup`, opening connections for `aquery`. Over
+        HTTP/2, a single connection is opened and shared.
+        """
+        aclient = self._get_async_client()
+
+        async def ping():
+            try:
+                await aclient.get(self.warmup_url)
+            except httpx.HTTPError:
+                pass
+
+        await asyncio.gather(*(ping() for _ in range(n)))
+
+    def _get_async_client(self) -> httpx.AsyncClient:
+        # Pooled connections are bound to the event loop they were opened on
+        loop = asyncio.get_running_loop()
+        if self._aclient is None or self._aclient_loop is not loop:
+            # A client left open on a loop that is still alive is closed on it, while
+            # one on a closed loop can no longer be, which `arelease` avoids
+            if self._aclient is not None and not self._aclient_loop.is_closed():
+                asyncio.run_coroutine_threadsafe(
+                    self._aclient.aclose(), self._aclient_loop
+                )
+            self._aclient = httpx.AsyncClient(
+                headers=self._headers,
+                http2=self._http2,
+                # httpx only keeps 20 idle connections alive by default, so bursts
+                # beyond that would reconnect on every query
+                limits=httpx.Limits(
+                    max_connections=self._max_connections,
+                    max_keepalive_connections=self._max_connections,
+                ),
+                timeout=httpx.Timeout(_READ_TIMEOUT_S, connect=_CONNECT_TIMEOUT_S),
+            )
+            self._aclient_loop = loop
+        return self._aclient
+
+    async def arelease(self):
+        """
+        Closes the asynchronous client if it was created on the running event loop.
+        """
+        if (
+            self._aclient is not None
+            and self._aclient_loop is asyncio.get_running_loop()
+        ):
+            aclient, self._aclient = self._aclient, None
+            await aclient.aclose()
+
+    def close(self):
+        """
+        Closes the underlying session, releasing all pooled connections.
+        """
+        self._session.close()
+
+    async def aclose(self):
+        """
+        Closes both the underlying session and the asynchronous client, if one was created.
+        """
+        self.close()
+        if self._aclient is not None:
+            await self._aclient.aclose()
+            self._aclient = None
+
+    def __del__(self):
+        session = getattr(self, "_session", None)
+        if session is not None:
+            session.close()
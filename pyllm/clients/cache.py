@@ -0,0 +1,46 @@
+import os
+import json
+import hashlib
+
+from typing import Dict, List, Optional
+
+from pyllm.utils.caching import CACHE_DIR, TieredCache
+from pyllm.utils.types import SamplingParams, sampling_params_dict
+
+
+class ResponseCache(TieredCache):
+    """
+    A two-tier cache of model responses, keyed by the full request.
+
+    Attributes:
+        maxsize (int): The maximum number of responses kept in memory.
+    """
+
+    _CACHE_FILE = os.path.join(CACHE_DIR, "cached_responses.db")
+
+    def __init__(self, path: Optional[str] = None, maxsize: int = 1024):
+        """
+        Args:
+            path (Optional[str]): The path to the SQLite database the responses are
+                persisted to. Defaults to a file in the user's cache directory.
+            maxsize (int): The maximum number of responses kept in memory.
+        """
+        super().__init__(path or self._CACHE_FILE, maxsize)
+
+    @staticmethod
+    def key(
+        model_name: str, messages: List[Dict], sampling_params: SamplingParams
+    ) -> str:
+        """
+        Computes the cache key of a request.
+
+        Returns:
+            str: A hex digest uniquely identifying the model, messages, and sampling
+                parameters of the request.
+        """
+        request = {
+            "model": model_name,
+            "messages": messages,
+            "sampling_params": dict(sampling_params_dict(sampling_params)),
+        }
+        return hashlib.blake2b(json.dumps(request, sort_keys=True).encode()).hexdigest()
@@ -0,0 +1,192 @@
+import time
+import uuid
+import orjson
+import requests
+import threading
+
+from typing import Dict, Optional
+
+from pyllm.clients import Client, OpenAIChatClient
+from pyllm.clients.base import _CONNECT_TIMEOUT_S, _READ_TIMEOUT_S
+from pyllm.utils.types import SamplingParams
+from pyllm.utils.registry import CLIENT_REGISTRY
+
+
+@CLIENT_REGISTRY.register("openai-batch")
+class OpenAIBatchClient(OpenAIChatClient):
+    """
+    A client for querying OpenAI's Batch API, which runs chat completions offline at a
+    lower cost, in exchange for results coming back within the completion window rather
+    than immediately.
+
+    Requests are buffered with `submit` and sent together as a single batch by `flush`,
+    which blocks until the batch is done.
+
+    https://platform.openai.com/docs/guides/batch
+
+    Attributes:
+        completion_window (str): The time frame within which the batch should be processed.
+        poll_interval_s (float): The number of seconds to wait between checks of the batch's
+            status.
+    """
+
+    def __init__(
+        self,
+        *args,
+        completion_window: str = "24h",
+        poll_interval_s: float = 30,
+        **kwargs,
+    ):
+        """
+        Args:
+            completion_window (str): The time frame within which the batch should be
+                processed. Defaults to '24h', the only window currently supported.
+            poll_interval_s (float): The number of seconds to wait between checks of the
+                batch's status. Defaults to 30.
+
+        All other arguments are passed on to OpenAIChatClient.
+        """
+        super().__init__(*args, **kwargs)
+        self.completion_window = completion_window
+        self.poll_interval_s = float(poll_interval_s)
+        self._pending: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    def submit(
+        self,
+        prompt: Optional[str] = None,
+        messages: Optional[Dict] = None,
+        sampling_params: SamplingParams = SamplingParams(),
+    ) -> str:
+        """
+        Adds a request to the next batch, taking the same arguments as `query`.
+
+        Returns:
+            str: The ID of the request, which its response is mapped to by `flush`.
+        """
+        body = self._build_body(self._build_messages(prompt, messages), sampling_params)
+        custom_id = uuid.uuid4().hex
+        with self._lock:
+            self._pending[custom_id] = body
+        return custom_id
+
+    def flush(self) -> Dict[str, str]:
+        """
+        Sends all submitted requests as a single batch and waits for it to finish.
+
+        Returns:
+            Dict[str, str]: The content of the message returned by the model for every
+                request ID returned by `submit`. Requests that failed are left out.
+
+        Raises:
+            requests.RequestException: If uploading, creating, or retrieving the batch
+                fails, or if the batch did not complete.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return {}
+
+        batch_file = b"\n".join(
+            orjson.dumps(
+                {
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": body,
+                }
+            )
+            for custom_id, body in pending.items()
+        )
+        # Let requests set the multipart content type instead of the session's JSON one
+        input_file = self._request(
+            "POST",
+            "v1/files",
+            data={"purpose": "batch"},
+            files={"file": ("batch.jsonl", batch_file)},
+            headers={"Content-Type": None},
+        )
+        batch = self._request(
+            "POST",
+            "v1/batches",
+            data=orjson.dumps(
+                {
+                    "input_file_id": input_file["id"],
+                    "endpoint": "/v1/chat/completions",
+                    "completion_window": self.completion_window,
+                }
+            ),
+        )
+
+        while batch["status"] not in ("completed", "failed", "expired", "cancelled"):
+            time.sleep(self.poll_interval_s)
+            batch = self._request("GET", f"v1/batches/{batch['id']}")
+
+        if batch["status"] != "completed":
+            raise requests.RequestException(
+                self._error(f"Batch {batch['id']} did not complete: {batch['status']}")
+            )
+        if batch["output_file_id"] is None:
+            return {}
+
+        res = self._session.get(
+            self.base_url + f"v1/files/{batch['output_file_id']}/content",
+            timeout=(_CONNECT_TIMEOUT_S, _READ_TIMEOUT_S),
+        )
+        if res.status_code != 200:
+            raise requests.RequestException(res.content)
+
+        responses = {}
+        for line in res.content.splitlines():
+            result = orjson.loads(line)
+            response = result["response"]
+            if response is not None and response["status_code"] == 200:
+                responses[result["custom_id"]] = response["body"]["choices"][0][
+                    "message"
+                ]["content"]
+        return responses
+
+    def query(
+        self,
+        prompt: Optional[str] = None,
+        messages: Optional[Dict] = None,
+        sampling_params: SamplingParams = SamplingParams(),
+    ) -> str:
+        """
+        Queries the model through a batch of its own, along with any other submitted
+        requests. This blocks until the batch is done, so `submit` and `flush` should be
+        preferred when there are many requests to send.
+
+        Returns:
+            str: The content of the message returned by the model as a response to the query.
+
+        Raises:
+            requests.RequestException: If the batch or this request failed.
+        """
+        custom_id = self.submit(prompt, messages, sampling_params)
+        responses = self.flush()
+        if custom_id not in responses:
+            raise requests.RequestException(
+                self._error(f"Request {custom_id} of the batch failed")
+            )
+        return responses[custom_id]
+
+    # All go through `query` rather than the real-time endpoint
+    query_stream = Client.query_stream
+    aquery = Client.aquery
+    aquery_stream = Client.aquery_stream
+
+    def _request(self, method: str, path: str, **kwargs) -> Dict:
+        res = self._session.request(
+            method,
+            self.base_url + path,
+            timeout=(_CONNECT_TIMEOUT_S, _READ_TIMEOUT_S),
+            **kwargs,
+        )
+        if res.status_code != 200:
+            raise requests.RequestException(res.content)
+        return orjson.loads(res.content)
+
+    def _error(self, message: str) -> bytes:
+        # Mirrors the body of an API error response
+        return orjson.dumps({"error": {"message": message}})
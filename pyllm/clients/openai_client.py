@@ -1,17 +1,13 @@
 import os
-import requests
-import json
 
 from typing import Dict, Optional
-from dataclasses import asdict
 
-from pyllm.clients import Client
-from pyllm.utils.types import SamplingParams
+from pyllm.clients import ChatCompletionsClient
 from pyllm.utils.registry import CLIENT_REGISTRY
 
 
 @CLIENT_REGISTRY.register("openai")
-class OpenAIChatClient(Client):
+class OpenAIChatClient(ChatCompletionsClient):
     """
     A client for querying an OpenAI API endpoint, specifically designed for chat completions.
 
@@ -31,6 +27,10 @@ class OpenAIChatClient(Client):
         base_url: str = "https://api.openai.com",
         api_key: Optional[str] = None,
         org_id: Optional[str] = None,
+        max_connections: int = 32,
+        http2: bool = True,
+        cache: bool = False,
+        max_retries: int = 5,
     ):
         """
         Initializes the OpenAIChatClient with API key, model name, organization ID, and base URL.
@@ -44,6 +44,16 @@ class OpenAIChatClient(Client):
             api_key (Optional[str]): Optional API key for authentication. If not provided,
                 attempts to retrieve it from the environment variable OPENAI_API_KEY.
             org_id (Optional[str]): Optional organization ID for usage with OpenAI's API.
+            max_connections (int): The maximum number of keep-alive connections kept open
+                to the API. Defaults to 32.
+            http2 (bool): Whether to use HTTP/2 for asynchronous queries when the
+                server supports it. Defaults to True.
+            cache (bool): Whether to cache responses by request, on disk and in memory.
+                Responses sampled with a temperature of 0 are cached whatever their
+                seed. Defaults to False.
+            max_retries (int): The maximum number of times a request is retried after
+                being rate limited or failing with a transient server error. Defaults
+                to 5.
 
         Raises:
             KeyError: If no API key is provided directly or found in the environment variables.
@@ -59,43 +69,19 @@ class OpenAIChatClient(Client):
         self.model_name = model_name
         self.org_id = org_id
         self.base_url = base_url if base_url[-1] == "/" else base_url + "/"
-
-    def query(
-        self,
-        prompt: Optional[str] = None,
-        messages: Optional[Dict] = None,
-        sampling_params: SamplingParams = SamplingParams(),
-    ) -> str:
-        """
-        Queries the OpenAI API endpoint with a given prompt and sampling parameters.
-
-        Args:
-            prompt (str): The prompt to send to the model.
-            params (SamplingParams): An instance of SamplingParams specifying parameters
-                for the query, such as temperature, max tokens, etc.
-
-        Returns:
-            str: The content of the message returned by the model as a response to the query.
-
-        Raises:
-            requests.RequestException: If the request to the OpenAI API fails or returns a
-                non-200 status code, with the response content included in the exception message.
-        """
-        if (not prompt and not messages) or (prompt and messages):
-            raise ValueError("Pass either a string prompt or messages dict")
-
-        headers = {"Authorization": f"Bearer {self.api_key}"}
-
-        body = {
-            "model": self.model_name,
-            "messages": messages if messages else [{"role": "user", "content": prompt}],
-            **asdict(sampling_params),
-        }
-
-        completions_url = self.base_url + "v1/chat/completions"
-        res = requests.post(completions_url, json=body, headers=headers)
-
-        if res.status_code != 200:
-            raise requests.RequestException(res.content)
-
-        return json.loads(res.content)["choices"][0]["message"]["content"]
+        self.completions_url = self.base_url + "v1/chat/completions"
+
+        super().__init__(
+            {"Authorization": f"Bearer {self.api_key}"},
+            max_connections=max_connections,
+            http2=http2,
+            cache=cache,
+            max_retries=max_retries,
+        )
+
+    @property
+    def warmup_url(self) -> str:
+        return self.base_url + "v1/models"
+
+    def _body_fields(self) -> Dict:
+        return {"model": self.model_name}
@@ -1,23 +1,116 @@
 import argparse
+import ast
+import asyncio
+import inspect
 import logging
+import typing
 
-from typing import List, Dict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from typing import Any, List, Dict, Optional
 from tabulate import tabulate
 
 
 from pyllm.utils.registry import CLIENT_REGISTRY, METHOD_REGISTRY, DATASET_REGISTRY
-from pyllm.interfaces import CodeGenerator
+from pyllm.clients import ChatCompletionsClient, OpenAIBatchClient
+from pyllm.interfaces import CodeGenerator, CodeLLM
 from pyllm.function_datasets.base import FunctionDataset
-from tqdm import tqdm
+from tqdm.auto import tqdm
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
+# Rows served from a cache complete far faster than the bar needs refreshing, so it is
+# redrawn at most twice a second and the accuracy is only recomputed every few rows
+_progress_bar = partial(tqdm, mininterval=0.5, maxinterval=2.0, smoothing=0.1)
+_POSTFIX_EVERY = 10
+
 
 def evaluate(
-    methods: List[str], datasets: List[str], client_name: str, client_args: dict
+    methods: List[str],
+    datasets: List[str],
+    client_name: str,
+    client_args: dict,
+    max_workers: int = 1,
+):
+    """
+    Evaluates the methods on the datasets, defining the functions for up to
+    `max_workers` rows of a dataset at a time on threads. Unless given in
+    `client_args`, the client's connection pool is sized to match.
+    """
+    if issubclass(CLIENT_REGISTRY[client_name], ChatCompletionsClient):
+        client_args = {"max_connections": max_workers, **client_args}
+    client = CLIENT_REGISTRY.build(client_name, **client_args)
+    methods: Dict[str, CodeGenerator] = {
+        method: METHOD_REGISTRY.build(method, client=client) for method in methods
+    }
+    datasets: Dict[str, FunctionDataset] = {
+        dataset: DATASET_REGISTRY.build(dataset) for dataset in datasets
+    }
+
+    if isinstance(client, OpenAIBatchClient):
+        _print_summary(
+            _evaluate_batch(client, methods, datasets), list(datasets.keys())
+        )
+        return
+
+    # Connections are opened up front, as many as there are rows evaluated at once
+    client.warmup(max_workers)
+
+    def evaluate_row(method_name: str, dataset_name: str, row) -> bool:
+        try:
+            methods[method_name].def_function(
+                row.prompt, unit_tests=row.unit_tests, use_cached=False
+            )
+            return True
+        except Exception as e:
+            logging.error(
+                f"Error evaluating method {method_name} on dataset {dataset_name}: {e}"
+            )
+            return False
+
+    results = {}
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        for method_name in methods:
+            results[method_name] = {}
+            for dataset_name, dataset in datasets.items():
+                futures = [
+                    executor.submit(evaluate_row, method_name, dataset_name, row)
+                    for row in dataset
+                ]
+                correct, total = 0, 0
+                pbar = _progress_bar(
+                    total=len(futures), desc=f"{dataset_name} - {method_name}"
+                )
+                for outcome in as_completed(futures):
+                    correct += outcome.result()
+                    total += 1
+                    pbar.update()
+                    if total % _POSTFIX_EVERY == 0 or total == len(futures):
+                        pbar.set_postfix({"Accuracy": correct / total})
+                pbar.close()
+
+                results[method_name][dataset_name] = correct / total
+
+    _print_summary(results, list(datasets.keys()))
+
+
+async def aevaluate(
+    methods: List[str],
+    datasets: List[str],
+    client_name: str,
+    client_args: dict,
+    max_workers: int = 8,
 ):
+    """
+    Asynchronous counterpart of `evaluate`, which defines the functions for all the rows
+    of a dataset concurrently, with at most `max_workers` of them in flight at a time.
+    Unless given in `client_args`, the client's connection pool is sized to match.
+    """
+    if issubclass(CLIENT_REGISTRY[client_name], ChatCompletionsClient):
+        client_args = {"max_connections": max_workers, **client_args}
     client = CLIENT_REGISTRY.build(client_name, **client_args)
     methods: Dict[str, CodeGenerator] = {
         method: METHOD_REGISTRY.build(method, client=client) for method in methods
@@ -26,38 +119,167 @@ def evaluate(
         dataset: DATASET_REGISTRY.build(dataset) for dataset in datasets
     }
 
+    if isinstance(client, OpenAIBatchClient):
+        _print_summary(
+            _evaluate_batch(client, methods, datasets), list(datasets.keys())
+        )
+        return
+
+    semaphore = asyncio.Semaphore(max_workers)
+
+    async def evaluate_row(method_name: str, dataset_name: str, row) -> bool:
+        async with semaphore:
+            try:
+                await methods[method_name].adef_function(
+                    row.prompt, unit_tests=row.unit_tests, use_cached=False
+                )
+                return True
+            except Exception as e:
+                logging.error(
+                    f"Error evaluating method {method_name} on dataset {dataset_name}: {e}"
+                )
+                return False
+
     results = {}
 
+    try:
+        # Connections are opened up front, rather than by the first `max_workers` rows
+        # at once, and released with the rest even if no row is evaluated
+        await client.awarmup(max_workers)
+        for method_name in methods:
+            results[method_name] = {}
+            for dataset_name, dataset in datasets.items():
+                tasks = [
+                    evaluate_row(method_name, dataset_name, row) for row in dataset
+                ]
+                correct, total = 0, 0
+                pbar = _progress_bar(
+                    total=len(tasks), desc=f"{dataset_name} - {method_name}"
+                )
+                for outcome in asyncio.as_completed(tasks):
+                    correct += await outcome
+                    total += 1
+                    pbar.update()
+                    if total % _POSTFIX_EVERY == 0 or total == len(tasks):
+                        pbar.set_postfix({"Accuracy": correct / total})
+                pbar.close()
+
+                results[method_name][dataset_name] = correct / total
+    finally:
+        # Connections opened on the loop are closed before `asyncio.run` closes it,
+        # including those of clients the methods build for themselves
+        for method in methods.values():
+            await method.arelease()
+        await client.arelease()
+
+    _print_summary(results, list(datasets.keys()))
+
+
+def _evaluate_batch(
+    client: OpenAIBatchClient,
+    methods: Dict[str, CodeGenerator],
+    datasets: Dict[str, FunctionDataset],
+) -> Dict[str, Dict[str, float]]:
+    """
+    Evaluates methods through a batch client, by submitting the prompts of every row up
+    front as a single batch and unit testing the returned functions once it is done.
+
+    Only methods that define a function from a single model response can be evaluated
+    this way.
+    """
+    for method_name, method in methods.items():
+        if not isinstance(method, CodeLLM):
+            raise ValueError(
+                f"Method {method_name} needs more than one response per function and can't be evaluated in a batch"
+            )
+
+    submitted = {}
     for method_name, method in methods.items():
-        # logging.info(f"Evaluating method: {method_name}")
-        results[method_name] = {}
         for dataset_name, dataset in datasets.items():
-            # logging.info(f"Evaluating dataset: {dataset_name}")
-            correct, total = 0, 0
-            pbar = tqdm(dataset, desc=f"{dataset_name} - {method_name}")
-            for row in pbar:
-                try:
-                    method.def_function(
-                        row.prompt, unit_tests=row.unit_tests, use_cached=False
-                    )
-                    correct += 1
-                except Exception as e:
-                    logging.error(
-                        f"Error evaluating method {method_name} on dataset {dataset_name}: {e}"
-                    )
-                finally:
-                    total += 1
-                    pbar.set_postfix({"Accuracy": correct / total})
+            submitted[method_name, dataset_name] = [
+                (
+                    client.submit(
+                        method.format_prompt(row.prompt, unit_tests=row.unit_tests)
+                    ),
+                    row,
+                )
+                for row in dataset
+            ]
+
+    logging.info(f"Waiting for a batch of {sum(map(len, submitted.values()))} requests")
+    responses = client.flush()
+
+    results = {method_name: {} for method_name in methods}
+    for (method_name, dataset_name), requests in submitted.items():
+        method = methods[method_name]
+        correct = 0
+        for custom_id, row in _progress_bar(
+            requests, desc=f"{dataset_name} - {method_name}"
+        ):
+            if custom_id not in responses:
+                logging.error(
+                    f"Error evaluating method {method_name} on dataset {dataset_name}: the request failed"
+                )
+                continue
+            function = method.parse_and_test(responses[custom_id], row.unit_tests)
+            correct += function is not None
+
+        results[method_name][dataset_name] = correct / len(requests)
+
+    return results
+
 
-            results[method_name][dataset_name] = correct / total
-            # logging.info(f"Method {method_name} Accuracy: {correct / total:.2%}")
+def _parse_client_arg(client_cls: type, name: str, value: str):
+    # Numbers and booleans are passed as such to parameters that take them, while
+    # arguments of string parameters, such as keys and names that happen to look like
+    # numbers, are passed on unchanged
+    parameters = _init_parameters(client_cls)
+    if name not in parameters:
+        raise ValueError(
+            f"{client_cls.__name__} has no argument '{name}', expected one of "
+            + ", ".join(parameters)
+        )
+
+    annotation = parameters[name]
+    if annotation is None or annotation is str or str in typing.get_args(annotation):
+        return value
+    if annotation is bool or bool in typing.get_args(annotation):
+        # Anything else would be passed on as a string, which is always truthy
+        if value.lower() not in ("true", "false"):
+            raise ValueError(f"Argument '{name}' should be true or false, got {value}")
+        return value.lower() == "true"
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return value
+
+
+def _init_parameters(cls: type) -> Dict[str, Optional[Any]]:
+    # The named parameters of the constructor with their annotations, following those
+    # that subclasses pass on to their bases through **kwargs
+    parameters = {}
+    for klass in cls.__mro__:
+        if "__init__" not in vars(klass) or klass is object:
+            continue
+        annotations = typing.get_type_hints(klass.__init__)
+        signature = inspect.signature(klass.__init__)
+        for parameter in list(signature.parameters.values())[1:]:
+            if parameter.kind not in (parameter.VAR_POSITIONAL, parameter.VAR_KEYWORD):
+                parameters.setdefault(parameter.name, annotations.get(parameter.name))
+        if not any(
+            parameter.kind == parameter.VAR_KEYWORD
+            for parameter in signature.parameters.values()
+        ):
+            break
+    return parameters
 
-    # Print summary
+
+def _print_summary(results: Dict[str, Dict[str, float]], dataset_names: List[str]):
     print("\nEvaluation Summary:")
     print(
         tabulate(
             [[k] + list(v.values()) for k, v in results.items()],
-            headers=list(datasets.keys()),
+            headers=dataset_names,
         )
     )
 
@@ -68,6 +290,21 @@ if __name__ == "__main__":
     parser.add_argument("--datasets", "-d", required=True, type=str)
     parser.add_argument("--client", "-c", default="openai", type=str)
     parser.add_argument("--client-args", "--client_args", "-ca", default="")
+    parser.add_argument(
+        "--backend",
+        "-b",
+        choices=["async", "sync"],
+        default="async",
+        help="Evaluate rows concurrently on an event loop, or one at a time",
+    )
+    parser.add_argument(
+        "--max-workers",
+        "--max_workers",
+        "-w",
+        default=8,
+        type=int,
+        help="The maximum number of rows evaluated concurrently",
+    )
 
     args = parser.parse_args()
 
@@ -81,18 +318,43 @@ if __name__ == "__main__":
     else:
         datasets = args.datasets.split(",")
     client_name = args.client
+    if client_name not in CLIENT_REGISTRY:
+        parser.error(
+            f"unknown client '{client_name}', expected one of "
+            + ", ".join(CLIENT_REGISTRY._classes_dict)
+        )
 
-    client_args = args.client_args.split(",")
-    client_args = {
-        arg.split("=")[0]: "=".join(arg.split("=")[1:]) for arg in client_args
-    }
+    client_args = [arg for arg in args.client_args.split(",") if arg]
+    try:
+        client_args = {
+            arg.split("=")[0]: _parse_client_arg(
+                CLIENT_REGISTRY[client_name],
+                arg.split("=")[0],
+                "=".join(arg.split("=")[1:]),
+            )
+            for arg in client_args
+        }
+    except ValueError as e:
+        parser.error(str(e))
 
     print(f"Evaluating methods: {methods}")
     print(f"Evaluating datasets: {datasets}")
 
-    evaluate(
-        methods=methods,
-        datasets=datasets,
-        client_name=client_name,
-        client_args=client_args,
-    )
+    if args.backend == "async":
+        asyncio.run(
+            aevaluate(
+                methods=methods,
+                datasets=datasets,
+                client_name=client_name,
+                client_args=client_args,
+                max_workers=args.max_workers,
+            )
+        )
+    else:
+        evaluate(
+            methods=methods,
+            datasets=datasets,
+            client_name=client_name,
+            client_args=client_args,
+            max_workers=args.max_workers,
+        )
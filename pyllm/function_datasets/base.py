@@ -3,7 +3,7 @@ from dataclasses import dataclass
 from typing import List, Tuple, Iterator
 
 
-@dataclass
+@dataclass(frozen=True)
 class EvaluationRow:
     prompt: str
     unit_tests: List[Tuple]
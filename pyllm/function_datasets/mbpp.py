@@ -1,69 +1,230 @@
+import ast
+import builtins
 import re
 import logging
 
-from typing import List, Tuple, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import List, Optional, Tuple, Iterator
 from datasets import Dataset, load_dataset
 from pyllm.utils.registry import DATASET_REGISTRY
 from pyllm.function_datasets.base import EvaluationRow, FunctionDataset
 
+# Also captures the case where the output of the function is first turned into a set in
+# the assertion, in which case the call's parenthesis is followed by the set's
+_ASSERT_RE = re.compile(
+    r"^assert (?P<set>set\()?\w+\((?P<inp>.+)\)(?(set)\))\s?==\s?(?P<out>.+)$"
+)
+
+
+# Values that aren't literals are evaluated, but only if they are made of literals,
+# arithmetic, comparisons, a comprehension, and calls to these builtins, rather than
+# arbitrary code from the dataset
+_SAFE_BUILTINS = {
+    name: getattr(builtins, name)
+    for name in (
+        "abs",
+        "bool",
+        "dict",
+        "float",
+        "frozenset",
+        "int",
+        "len",
+        "list",
+        "max",
+        "min",
+        "round",
+        "set",
+        "sorted",
+        "str",
+        "sum",
+        "tuple",
+    )
+}
+_SAFE_NODES = (
+    ast.Expression,
+    ast.Constant,
+    ast.Tuple,
+    ast.List,
+    ast.Set,
+    ast.Dict,
+    ast.Load,
+    ast.Store,
+    ast.BinOp,
+    ast.UnaryOp,
+    ast.BoolOp,
+    ast.Compare,
+    ast.IfExp,
+    ast.Subscript,
+    ast.Slice,
+    ast.operator,
+    ast.unaryop,
+    ast.boolop,
+    ast.cmpop,
+    ast.Call,
+    ast.keyword,
+    ast.Name,
+    ast.ListComp,
+    ast.SetComp,
+    ast.DictComp,
+    ast.GeneratorExp,
+    ast.comprehension,
+)
+# Powers and shifts grow their result exponentially, so they are only evaluated with a
+# small constant exponent, of a base that isn't a power or shift itself, and ranges are
+# bounded in length. A single comprehension is allowed, as nested loops would multiply
+# their lengths.
+_MAX_EXPONENT = 64
+_MAX_RANGE = 10**4
+
+
+def _bounded_range(*args) -> range:
+    values = range(*args)
+    try:
+        too_long = len(values) > _MAX_RANGE
+    except OverflowError:
+        # Ranges longer than the largest index don't even have a length
+        too_long = True
+    if too_long:
+        raise ValueError(f"{values} is longer than {_MAX_RANGE}")
+    return values
+
+
+def _check_safe(expression: str, tree: ast.Expression):
+    names = set(_SAFE_BUILTINS) | {"range"}
+    comprehensions = 0
+    for node in ast.walk(tree):
+        if isinstance(node, ast.comprehension):
+            comprehensions += 1
+            names.update(
+                name.id for name in ast.walk(node.target) if isinstance(name, ast.Name)
+            )
+    if comprehensions > 1:
+        raise ValueError(f"{expression} has more than one comprehension")
+
+    for node in ast.walk(tree):
+        if not isinstance(node, _SAFE_NODES) or (
+            isinstance(node, ast.Name) and node.id not in names
+        ):
+            raise ValueError(f"{expression} is not a safe expression to evaluate")
+        if _is_power(node):
+            if not (
+                isinstance(node.right, ast.Constant)
+                and isinstance(node.right.value, int)
+                and abs(node.right.value) <= _MAX_EXPONENT
+                and not any(_is_power(child) for child in ast.walk(node.left))
+            ):
+                raise ValueError(f"{expression} has an unbounded power or shift")
+
+
+def _is_power(node: ast.AST) -> bool:
+    return isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Pow, ast.LShift))
+
+
+def _parse_value(expression: str):
+    try:
+        return ast.literal_eval(expression)
+    except ValueError:
+        logging.debug(f"{expression} is not a literal, evaluating it instead")
+
+    tree = ast.parse(expression.strip(), mode="eval")
+    _check_safe(expression, tree)
+    return eval(
+        compile(tree, "<mbpp>", "eval"),
+        {"__builtins__": {**_SAFE_BUILTINS, "range": _bounded_range}},
+    )
+
+
+def _strip_message(test: str) -> str:
+    # The message of an assertion would otherwise be parsed as part of its output
+    try:
+        node = ast.parse(test.strip()).body[0]
+    except (SyntaxError, IndexError):
+        return test
+    if not isinstance(node, ast.Assert) or node.msg is None:
+        return test
+    return "assert " + ast.get_source_segment(test.strip(), node.test)
+
+
+def _get_unit_tests(row: dict) -> List[Tuple]:
+    unit_tests = []
+    for test in row["test_list"]:
+        if match := _ASSERT_RE.match(_strip_message(test)):
+            unit_tests.append((_parse_value(match["inp"]), _parse_value(match["out"])))
+
+    return unit_tests
+
+
+# Module-level so that rows can be parsed in worker processes
+def _to_evaluation_row(row: dict, prompt_key: str) -> Optional[EvaluationRow]:
+    try:
+        unit_tests = _get_unit_tests(row)
+    except Exception as e:
+        logging.warning(
+            f"Skipping task {row['task_id']}. Got the following error when trying to parse its unit tests: {e}"
+        )
+        return None
+    return EvaluationRow(row[prompt_key], unit_tests)
+
 
 class BaseMBPP(FunctionDataset):
-    def __init__(self, dataset: Dataset) -> None:
+    prompt_key: str = "text"
+
+    def __init__(self, dataset: Dataset, num_proc: Optional[int] = None) -> None:
         super().__init__(dataset._data, info=dataset.info, split=dataset.split)
+        self.num_proc = num_proc
+        self._rows: Optional[List[EvaluationRow]] = None
 
     def __getitem__(self, key) -> EvaluationRow:
         row = super().__getitem__(key)
         return self._to_evaluation_row(row)
 
-    def _to_evaluation_row(self, row: dict, prompt_key: str = "text") -> EvaluationRow:
-        try:
-            unit_tests = self.get_unit_tests(row)
-        except Exception as e:
-            logging.warning(
-                f"Skipping task {row['task_id']}. Got the following error when trying to parse its unit tests: {e}"
-            )
-            return None
-        return EvaluationRow(row[prompt_key], unit_tests)
+    def _to_evaluation_row(self, row: dict) -> EvaluationRow:
+        return _to_evaluation_row(row, self.prompt_key)
+
+    @property
+    def rows(self) -> List[EvaluationRow]:
+        """
+        The rows whose unit tests could be parsed. They are only parsed the first time
+        they are needed, across `num_proc` processes if given, and reused by every later
+        iteration over the dataset.
+        """
+        if self._rows is None:
+            if self.num_proc is not None and self.num_proc > 1:
+                with ProcessPoolExecutor(self.num_proc) as pool:
+                    rows = list(
+                        pool.map(
+                            partial(_to_evaluation_row, prompt_key=self.prompt_key),
+                            super().__iter__(),
+                            chunksize=16,
+                        )
+                    )
+            else:
+                rows = map(self._to_evaluation_row, super().__iter__())
+            self._rows = [row for row in rows if row is not None]
+        return self._rows
 
     def __iter__(self) -> Iterator[EvaluationRow]:
-        return filter(
-            lambda x: x is not None, map(self._to_evaluation_row, super().__iter__())
-        )
+        return iter(self.rows)
 
     def get_unit_tests(self, row) -> List[Tuple]:
-        unit_tests = []
-        for test in row["test_list"]:
-            # Capture the case where the output of the function is first turned into a set in the assertion
-            if test.startswith("assert set("):
-                match = re.search(r"^assert (?:set\()?\w+\((.+)\)\)\s?==\s?(.+)$", test)
-            else:
-                match = re.search(r"^assert \w+\((.+)\)\s?==\s?(.+)$", test)
-
-            if match:
-                inp, out = match.groups()
-                inp, out = eval(inp), eval(out)
-                unit_tests.append((inp, out))
-            else:
-                pass
-
-        return unit_tests
+        return _get_unit_tests(row)
 
 
 @DATASET_REGISTRY.register("mbpp")
 class MBPP(BaseMBPP):
-    def __init__(self) -> None:
+    def __init__(self, num_proc: Optional[int] = None) -> None:
         self._dataset = load_dataset("mbpp")["test"]
 
-        super().__init__(self._dataset)
+        super().__init__(self._dataset, num_proc)
 
 
 @DATASET_REGISTRY.register("mbpp-sanitized")
 class MBPPSanitized(BaseMBPP):
-    def __init__(self) -> None:
-        self._dataset = load_dataset("mbpp", "sanitized")["test"]
+    # sanitized version renames "text" to "prompt"
+    prompt_key = "prompt"
 
-        super().__init__(self._dataset)
+    def __init__(self, num_proc: Optional[int] = None) -> None:
+        self._dataset = load_dataset("mbpp", "sanitized")["test"]
 
-    def _to_evaluation_row(self, row: dict) -> EvaluationRow:
-        # sanitized version renames "text" to "prompt"
-        return super()._to_evaluation_row(row, "prompt")
+        super().__init__(self._dataset, num_proc)
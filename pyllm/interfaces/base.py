@@ -1,13 +1,40 @@
+import os
+import json
+import asyncio
+import logging
+import contextlib
+import functools
+import threading
+import time
+import multiprocessing
+import multiprocessing.connection
 import timeout_decorator
 
-from typing import List, Tuple, Callable
+from typing import Any, List, Tuple, Callable, Optional, Union
 from dataclasses import dataclass
+from requests import RequestException
+from pyllm.parsers import Parser
 from pyllm.utils.types import Function
 from pyllm.utils.io_utils import swallow_io
 
+# Unit tests are usually run from threads, and a child forked from a process with other
+# threads running may inherit locks they hold, so workers start from a fresh interpreter
+# and parse the function from its source again instead
+if "forkserver" in multiprocessing.get_all_start_methods():
+    _CONTEXT = multiprocessing.get_context("forkserver")
+    # Workers are forked from a server that has imported this module once already
+    _CONTEXT.set_forkserver_preload([__name__])
+else:
+    _CONTEXT = multiprocessing.get_context("spawn")
+# Starting a worker and parsing the function doesn't count towards a test's time limit
+_STARTUP_TIMEOUT_S = 60
+
 
 @dataclass
 class UnitTestResult:
+    # Declared by hand, as dataclass(slots=True) needs Python 3.10
+    __slots__ = ("id", "x", "y", "yhat", "error")
+
     id: int
     x: int
     y: any
@@ -23,14 +50,99 @@ class CodeGenerator:
     def def_function(prompt: str, unit_tests: List[Tuple]) -> Function:
         pass
 
+    async def adef_function(self, *args, **kwargs) -> Function:
+        """
+        Asynchronous counterpart of `def_function`, taking the same arguments.
+
+        By default, `def_function` is run in the event loop's default executor. Subclasses
+        whose clients can be queried natively from the event loop should override this.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, functools.partial(self.def_function, *args, **kwargs)
+        )
+
+    async def adef_functions(
+        self,
+        prompts: List[str],
+        unit_tests: Optional[List[Optional[List[Tuple]]]] = None,
+        max_concurrency: int = 8,
+        **kwargs,
+    ) -> List[Union[Function, Exception]]:
+        """
+        Defines a function for each of the prompts, with up to `max_concurrency` of them
+        being defined at a time, so that the requests to the model overlap.
+
+        Args:
+            prompts (List[str]): The prompts describing the functions to be defined.
+            unit_tests (Optional[List[Optional[List[Tuple]]]]): The unit tests of the
+                function of each prompt, if any.
+            max_concurrency (int): The maximum number of functions being defined at a
+                time. Defaults to 8.
+
+        All other arguments are passed on to `adef_function` for every prompt.
+
+        Returns:
+            List[Union[Function, Exception]]: The function defined for each prompt, in
+                order, or the exception raised while defining it.
+        """
+        if unit_tests is None:
+            unit_tests = [None] * len(prompts)
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def define(prompt: str, prompt_unit_tests: Optional[List[Tuple]]):
+            async with semaphore:
+                return await self.adef_function(
+                    prompt, unit_tests=prompt_unit_tests, **kwargs
+                )
+
+        return await asyncio.gather(
+            *map(define, prompts, unit_tests), return_exceptions=True
+        )
+
+    def def_functions(self, *args, **kwargs) -> List[Union[Function, Exception]]:
+        """
+        Synchronous counterpart of `adef_functions`, taking the same arguments. It runs
+        its own event loop, so it can't be called from a running one.
+        """
+
+        async def define_all():
+            # Connections opened on the loop are closed before it is
+            try:
+                return await self.adef_functions(*args, **kwargs)
+            finally:
+                await self.arelease()
+
+        return asyncio.run(define_all())
+
+    async def arelease(self):
+        """
+        Releases anything the clients hold on the running event loop. Does nothing by
+        default.
+        """
+
+    def _log_request_error(self, e: RequestException, cur_try: int):
+        # Clients raise with the body of the error response, which is usually JSON but
+        # may be a gateway's error page, or the error may not come from a response at all
+        error_message = e.args[0] if e.args else e
+        if isinstance(error_message, bytes):
+            try:
+                error_message = json.loads(error_message)
+            except ValueError:
+                error_message = error_message.decode(errors="replace")
+        logging.warning(f"Try #{cur_try}, model query failed: {error_message}")
+
     @classmethod
     def unit_test(
         cls,
         function: Callable,
         unit_tests: List[Tuple],
         timeout_s: int = 5,
-        use_signals: bool = True,
-        quiet: bool = True
+        use_signals: Optional[bool] = None,
+        quiet: bool = True,
+        n_processes: Optional[int] = None,
+        source: Optional[str] = None,
+        parser: Optional[Parser] = None,
     ) -> List[UnitTestResult]:
         """
         Executes unit tests on a given function to validate its correctness.
@@ -39,34 +151,188 @@ class CodeGenerator:
             function (Callable): The function to be tested.
             unit_tests (List[Tuple]): A list of tuples, where each tuple
                 contains input(s) and the expected output.
+            timeout_s (int): The time limit for a single unit test, in seconds.
+            use_signals (Optional[bool]): Whether to enforce the time limit with
+                signals. Signals can only be used from the main thread, so by default
+                they are used only when running on it. Otherwise, if the function's
+                source is known, the tests are run concurrently in worker processes,
+                each of which parses the function again, runs its share of the tests
+                one after the other and is only replaced when a test times out or kills
+                it. As the workers import the main module, scripts running them need an
+                `if __name__ == "__main__":` guard. Without the source, every test runs
+                on a thread of its own, which is abandoned if it times out.
+            quiet (bool): Whether to swallow anything the function reads or writes
+                through the standard streams.
+            n_processes (Optional[int]): The number of processes the tests are spread
+                over when signals aren't used. Defaults to one per test, up to the
+                number of CPUs.
+            source (Optional[str]): The model response the function was parsed from,
+                taken from the function itself if it is a `Function`.
+            parser (Optional[Parser]): The parser that parsed the function from the
+                source.
         Returns:
             results (List[UnitTestResult])
         """
-        results = []
+        if isinstance(function, Function) and source is None:
+            source, parser = function.source, function.parser
+
+        if use_signals is None:
+            use_signals = threading.current_thread() is threading.main_thread()
+        if not use_signals and source is not None and parser is not None:
+            if n_processes is None:
+                n_processes = min(len(unit_tests), os.cpu_count() or 1)
+            outcomes = _unit_test_in_processes(
+                source,
+                parser,
+                [x for x, _ in unit_tests],
+                timeout_s,
+                quiet,
+                max(n_processes, 1),
+            )
+            return [
+                UnitTestResult(i, x, y, yhat, error)
+                for i, ((x, y), (yhat, error)) in enumerate(zip(unit_tests, outcomes))
+            ]
+
+        calls = [_unit_test_call(x) for x, _ in unit_tests]
+        if not use_signals:
+            # The streams are restored here, as a thread that timed out never returns
+            with swallow_io() if quiet else contextlib.nullcontext():
+                outcomes = [
+                    _run_unit_test_in_thread(function, call, timeout_s)
+                    for call in calls
+                ]
+        else:
+            function = timeout_decorator.timeout(timeout_s, use_signals=use_signals)(
+                function
+            )
+            if quiet:
+                function = swallow_io()(function)
+            outcomes = [_run_unit_test(function, call) for call in calls]
+
+        return [
+            UnitTestResult(i, x, y, yhat, error)
+            for i, ((x, y), (yhat, error)) in enumerate(zip(unit_tests, outcomes))
+        ]
+
+
+def _unit_test_call(x: Any) -> Callable[[Callable], Any]:
+    # Whether the input is spread over the function's arguments is decided once per test
+    if isinstance(x, tuple):
+        return lambda function: function(*x)
+    return lambda function: function(x)
+
+
+def _run_unit_test(function: Callable, call: Callable[[Callable], Any]) -> Tuple:
+    try:
+        return call(function), None
+    except Exception as e:
+        return None, e
+
+
+def _run_unit_test_in_thread(
+    function: Callable, call: Callable[[Callable], Any], timeout_s: int
+) -> Tuple:
+    # A thread can't be stopped, so one that times out is left running as a daemon
+    outcome = [(None, timeout_decorator.TimeoutError())]
 
-        function = timeout_decorator.timeout(timeout_s, use_signals=use_signals)(
-            function
+    def run():
+        outcome[0] = _run_unit_test(function, call)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout_s)
+    return outcome[0]
+
+
+def _unit_test_in_processes(
+    source: str,
+    parser: Parser,
+    inputs: List[Any],
+    timeout_s: int,
+    quiet: bool,
+    n_processes: int,
+) -> List[Tuple]:
+    # All processes are waited on from this thread. Every one runs the indices of its
+    # share of the tests that are left, and when a test times out or kills it, the rest
+    # of its share gets a new process.
+    outcomes = [None] * len(inputs)
+    workers = {}
+
+    def start(indices: List[int]):
+        receiver, sender = _CONTEXT.Pipe(duplex=False)
+        process = _CONTEXT.Process(
+            target=_run_unit_tests,
+            args=(source, parser, [inputs[i] for i in indices], sender, quiet),
+            daemon=True,
         )
+        process.start()
+        sender.close()
+        # The time limit only starts once the process has parsed the function
+        workers[receiver] = [process, indices, time.monotonic() + _STARTUP_TIMEOUT_S]
 
-        if quiet:
-            function = swallow_io()(function)
+    def stop(receiver, outcome: Optional[Tuple] = None):
+        process, indices, _ = workers.pop(receiver)
+        receiver.close()
+        if process.is_alive():
+            process.kill()
+        process.join()
+        if outcome is not None:
+            outcomes[indices[0]] = outcome
+            if indices[1:]:
+                start(indices[1:])
 
-        for i, (x, y) in enumerate(unit_tests):
-            try:
-                if type(x) is tuple:
-                    yhat = function(*x)
-                else:
-                    yhat = function(x)
-                results.append(
-                    UnitTestResult(
-                        **{"id": i, "error": None, "x": x, "y": y, "yhat": yhat}
-                    )
-                )
-            except Exception as e:
-                results.append(
-                    UnitTestResult(
-                        **{"id": i, "error": e, "x": x, "y": y, "yhat": None}
+    try:
+        for i in range(n_processes):
+            if indices := list(range(i, len(inputs), n_processes)):
+                start(indices)
+
+        while workers:
+            deadline = min(worker[2] for worker in workers.values())
+            ready = multiprocessing.connection.wait(
+                list(workers), timeout=max(deadline - time.monotonic(), 0)
+            )
+            for receiver in ready:
+                worker = workers[receiver]
+                try:
+                    outcome = receiver.recv()
+                except EOFError:
+                    stop(
+                        receiver, (None, RuntimeError("The unit test's process exited"))
                     )
-                )
+                    continue
+                worker[2] = time.monotonic() + timeout_s
+                if outcome is None:
+                    continue
+                outcomes[worker[1].pop(0)] = outcome
+                if not worker[1]:
+                    stop(receiver)
+
+            now = time.monotonic()
+            for receiver in [r for r, worker in workers.items() if worker[2] <= now]:
+                stop(receiver, (None, timeout_decorator.TimeoutError()))
+    finally:
+        for receiver in list(workers):
+            stop(receiver)
+
+    return outcomes
+
+
+def _run_unit_tests(
+    source: str, parser: Parser, inputs: List[Any], connection, quiet: bool
+):
+    # Runs in the worker process, sending back a message once the function is parsed,
+    # then the output or error of every test
+    function = parser.parse_function(source)
+    if quiet:
+        function = swallow_io()(function)
+    connection.send(None)
 
-        return results
+    for x in inputs:
+        outcome = _run_unit_test(function, _unit_test_call(x))
+        try:
+            connection.send(outcome)
+        except Exception as e:
+            # The output or the error couldn't be pickled
+            connection.send((None, e))
+    connection.close()
@@ -1,23 +1,58 @@
+import re
 import json
-import os
+import asyncio
+import hashlib
 import logging
-import timeout_decorator
+import functools
 
-from dataclasses import asdict
+from dataclasses import asdict, replace
 from typing import Optional, List, Tuple, Callable
-from random import randint
+from random import getrandbits
 from requests import RequestException
 
-from pyllm.clients import Client, OpenAIChatClient
+from pyllm.clients import Client, OpenAIChatClient, bypass_cache
+from pyllm import parsers
 from pyllm.parsers import Parser, RegExParser
 from pyllm.templates import PromptTemplate
 from pyllm.utils.exceptions import TooManyRetries, NothingToParseError
 from pyllm.interfaces import CodeGenerator
-from pyllm.utils.types import SamplingParams, Function
+from pyllm.utils.types import SamplingParams, Function, sampling_params_dict
 from pyllm.utils.caching import CacheHandler
+from pyllm.utils.concurrency import SingleFlight
 from pyllm.utils.registry import METHOD_REGISTRY
 
 
+@functools.lru_cache(maxsize=512)
+def _parse_cached(parser_name: str, model_response: str) -> Tuple[Parser, Callable]:
+    # Cache hits for the same response reuse its function instead of executing it again
+    parser = getattr(parsers, parser_name)()
+    return parser, parser.parse_function(model_response)
+
+
+# Code blocks, past the first complete one with a function in it the response is not
+# parsed. Fences open and close blocks alike, so they are told apart by their order.
+_FENCE_RE = re.compile(r"^[ \t]*```", re.MULTILINE)
+_TAGGED_CODE_RE = re.compile(r"<START-OF-CODE>.*?\bdef\b.*?<END-OF-CODE>", re.DOTALL)
+_DEF_RE = re.compile(r"\bdef\b")
+
+
+def _has_complete_code(response: str) -> bool:
+    if _TAGGED_CODE_RE.search(response) is not None:
+        return True
+    fences = [match.start() for match in _FENCE_RE.finditer(response)]
+    return any(
+        _DEF_RE.search(response, start, end) is not None
+        for start, end in zip(fences[::2], fences[1::2])
+    )
+
+
+# Appended to the prompt after a response that could not be parsed
+_PARSE_FEEDBACK = (
+    "\n\nA previous answer to this could not be parsed: {error}\n"
+    "Reply with the complete Python function in a single code block."
+)
+
+
 @METHOD_REGISTRY.register("baseline")
 class CodeLLM(CodeGenerator):
     """
@@ -31,6 +66,9 @@ class CodeLLM(CodeGenerator):
             executable functions.
         prompt_template (PromptTemplate): The template used to format prompts
             sent to the model.
+        cache (CacheHandler): The cache generated functions are stored in.
+        stream (bool): Whether responses are streamed, and cut off as soon as a
+            complete code block has arrived.
     """
 
     def __init__(
@@ -38,6 +76,7 @@ class CodeLLM(CodeGenerator):
         client: Optional[Client] = None,
         parser: Optional[Parser] = None,
         prompt_template: Optional[PromptTemplate] = None,
+        stream: bool = False,
     ):
         """
         Args:
@@ -47,6 +86,11 @@ class CodeLLM(CodeGenerator):
                 responses. Defaults to RegExParser if none is provided.
             prompt_template (Optional[PromptTemplate]): A template for generating
                 prompts. Defaults to PromptTemplate if none is provided.
+            stream (bool): Whether to stream responses and stop generating as soon
+                as a complete code block has arrived, rather than waiting for any
+                explanation the model adds after it. Streamed responses skip the
+                client's response cache and request deduplication. Defaults to
+                False.
         """
         if client is None:
             client = OpenAIChatClient()
@@ -59,34 +103,10 @@ class CodeLLM(CodeGenerator):
         if prompt_template is None:
             prompt_template = PromptTemplate()
         self.prompt_template = prompt_template
+        self.stream = stream
 
-    def _unit_test(self, function: Callable, unit_tests: List[Tuple]):
-        """
-        Executes unit tests on a given function to validate its correctness.
-
-        Args:
-            function (Callable): The function to be tested.
-            unit_tests (List[Tuple]): A list of tuples, where each tuple
-                contains input(s) and the expected output.
-        Raises:
-            AssertionError: If a unit test fails, indicating that the function
-                did not produce the expected output.
-        """
-        failures = []
-
-        function = timeout_decorator.timeout(5, use_signals=False)(function)
-
-        for x, y in unit_tests:
-            if type(x) is tuple:
-                yhat = function(*x)
-            else:
-                yhat = function(x)
-            if y != yhat:
-                error_message = f"{x} -> {yhat}, expected {y}."
-                failures.append(error_message)
-        assert (
-            not failures
-        ), f"{len(failures)}/{len(unit_tests)} tests failed:\n" + "\n".join(failures)
+        self.cache = CacheHandler.shared()
+        self._inflight = SingleFlight()
 
     def def_function(
         self,
@@ -108,11 +128,16 @@ class CodeLLM(CodeGenerator):
             output_types (Optional[List]): A list of output types for the function.
             unit_tests (Optional[List[Tuple]]): A list of tuples for unit testing
                 the function, where each tuple contains input(s) and expected output.
-            use_cached (bool): Whether to use cached responses. Defaults to True.
+            use_cached (bool): Whether to use cached responses. Defaults to True,
+                in which case concurrent calls for the same request also share a
+                single generation. Otherwise, the client's response cache is bypassed
+                as well.
             n_retries (int): The number of retries if querying the model or
                 parsing the response fails. Defaults to 1.
             sampling_params (SamplingParams): Parameters for sampling the model's
                 response. Defaults to an instance of SamplingParams with default values.
+                Unless a seed is given, a random one is drawn for the first try. Tries
+                after a response that failed use a new random seed.
 
         Returns:
             Function: A Function object encapsulating the defined function,
@@ -122,101 +147,357 @@ class CodeLLM(CodeGenerator):
             TooManyRetries: If the number of retries exceeds `n_retries` without
                 successful definition and validation of the function.
         """
-        model_response = None
-        parser = self.parser
-        # If cached, read it
-        if use_cached:
-            with CacheHandler("r") as f:
-                cache = json.load(f)
-                if prompt in cache:
-                    model_response = cache[prompt]["model_response"]
-                    sampling_params = SamplingParams(**cache[prompt]["sampling_params"])
-                    from pyllm import parsers
-
-                    parser = getattr(parsers, cache[prompt]["parser"])()
-                    function = parser.parse_function(model_response)
-
-        # Query the model if not cached
-        if model_response is None:
-            formatted_prompt = self.prompt_template.apply(
-                prompt=prompt,
-                object_type="function",
-                input_types=input_types,
-                output_types=output_types,
-                unit_tests=unit_tests,
+        formatted_prompt = self.format_prompt(
+            prompt, input_types, output_types, unit_tests
+        )
+        cache_key = self._cache_key(formatted_prompt, sampling_params)
+        args = (cache_key, prompt, formatted_prompt, unit_tests, n_retries)
+        if not use_cached:
+            # Neither are the responses the client may have cached
+            with bypass_cache():
+                return self._define_function(*args, sampling_params)
+
+        # Concurrent calls for the same request share a single generation
+        return self._inflight.do(
+            cache_key, self._cached_define_function, *args, sampling_params
+        )
+
+    def _cached_define_function(self, cache_key: str, *args) -> Function:
+        if (cached := self._read_cache(cache_key)) is not None:
+            return cached
+        return self._define_function(cache_key, *args)
+
+    def _define_function(
+        self,
+        cache_key: str,
+        prompt: str,
+        formatted_prompt: str,
+        unit_tests: Optional[List[Tuple]],
+        n_retries: int,
+        sampling_params: SamplingParams,
+    ) -> Function:
+        # A seed given by the caller is kept, so that the first try is reproducible
+        if sampling_params.seed is None:
+            sampling_params = replace(sampling_params, seed=getrandbits(62))
+        query_prompt, last_response = formatted_prompt, None
+        for cur_try in range(n_retries):
+            logging.debug(f"Try {cur_try}")
+            try:
+                model_response = self._query(query_prompt, sampling_params)
+            except RequestException as e:
+                self._log_request_error(e, cur_try)
+                continue
+
+            function, query_prompt = self._try_response(
+                formatted_prompt, model_response, last_response, unit_tests, cur_try
             )
-            for cur_try in range(n_retries):
-                seed = randint(0, 2**62)
-                sampling_params.seed = seed
-                logging.debug(f"Try {cur_try}")
-                try:
-                    model_response = self.client.query(
-                        formatted_prompt, sampling_params=sampling_params
-                    )
-                    logging.debug(f"Model response: {model_response}")
-                except RequestException as e:
-                    # retry if server fails to give 200 response
-                    error_message = json.loads(e.args[0].decode())
-                    logging.warning(
-                        f"Try #{cur_try}, model query failed: {error_message}"
-                    )
-                    continue
-
-                try:
-                    function = self.parser.parse_function(model_response)
-                except SyntaxError as e:
-                    # retry if parsing fails
-                    error_message = e.msg
-                    logging.warning(f"Try #{cur_try}, function parsing failed: {e}")
-                    continue
-                except NothingToParseError as e:
-                    logging.warning(f"Try #{cur_try}, {e}")
-                    logging.debug(
-                        f"No function found in the following model response:\n{model_response}"
-                    )
-                    continue
-
-                if unit_tests:
-                    unit_test_results = self.unit_test(function, unit_tests)
-                    print(model_response)
-                    print(unit_test_results)
-                    if failures := [
-                        result for result in unit_test_results if result.failed
-                    ]:
-                        error_message = (
-                            f"{len(failures)}/{len(unit_test_results)} test failed."
-                        )
-                        for result in failures:
-                            if result.error:
-                                error_message += f"\n{result.x} -> {result.y}, got error {result.error}"
-                            else:
-                                error_message += f"\n{result.x} -> {result.y}, got {result.yhat} instead."
-
-                        # retry if any unit test fails
-                        logging.warning(
-                            f"Try #{cur_try}, unit testing failed.\n{error_message}"
-                        )
-                        continue
+            # Break when code passes all tests
+            if function is not None:
+                break
+            last_response = model_response
+            # Only a failed response calls for a different one, so a request that
+            # failed is retried with the same seed
+            sampling_params = replace(sampling_params, seed=getrandbits(62))
+        else:
+            raise TooManyRetries(f"{n_retries=} exceeded.")
+
+        return self._write_cache(
+            cache_key, prompt, function, model_response, sampling_params
+        )
+
+    async def adef_function(
+        self,
+        prompt: str,
+        input_types: Optional[List] = None,
+        output_types: Optional[List] = None,
+        unit_tests: Optional[List[Tuple]] = None,
+        use_cached: bool = True,
+        n_retries: int = 1,
+        sampling_params: SamplingParams = SamplingParams(),
+    ) -> Function:
+        """
+        Asynchronous counterpart of `def_function`, taking the same arguments.
 
-                # Break when code passes all tests
+        The model is queried through the client's `aquery`, so many functions can be
+        defined concurrently on a single event loop.
+        """
+        formatted_prompt = self.format_prompt(
+            prompt, input_types, output_types, unit_tests
+        )
+        cache_key = self._cache_key(formatted_prompt, sampling_params)
+        args = (cache_key, prompt, formatted_prompt, unit_tests, n_retries)
+        if not use_cached:
+            with bypass_cache():
+                return await self._adefine_function(*args, sampling_params)
+
+        return await self._inflight.ado(
+            cache_key, self._acached_define_function, *args, sampling_params
+        )
+
+    async def arelease(self):
+        await self.client.arelease()
+
+    async def _acached_define_function(self, cache_key: str, *args) -> Function:
+        if (cached := self._read_cache(cache_key)) is not None:
+            return cached
+        return await self._adefine_function(cache_key, *args)
+
+    async def _adefine_function(
+        self,
+        cache_key: str,
+        prompt: str,
+        formatted_prompt: str,
+        unit_tests: Optional[List[Tuple]],
+        n_retries: int,
+        sampling_params: SamplingParams,
+    ) -> Function:
+        # A seed given by the caller is kept, so that the first try is reproducible
+        if sampling_params.seed is None:
+            sampling_params = replace(sampling_params, seed=getrandbits(62))
+        loop = asyncio.get_running_loop()
+        query_prompt, last_response = formatted_prompt, None
+        for cur_try in range(n_retries):
+            logging.debug(f"Try {cur_try}")
+            try:
+                model_response = await self._aquery(query_prompt, sampling_params)
+            except RequestException as e:
+                self._log_request_error(e, cur_try)
+                continue
+
+            # Parsing and unit testing are blocking, so they are kept off the loop
+            function, query_prompt = await loop.run_in_executor(
+                None,
+                functools.partial(
+                    self._try_response,
+                    formatted_prompt,
+                    model_response,
+                    last_response,
+                    unit_tests,
+                    cur_try,
+                ),
+            )
+            if function is not None:
                 break
+            last_response = model_response
+            sampling_params = replace(sampling_params, seed=getrandbits(62))
+        else:
+            raise TooManyRetries(f"{n_retries=} exceeded.")
+
+        return self._write_cache(
+            cache_key, prompt, function, model_response, sampling_params
+        )
+
+    def _try_response(
+        self,
+        formatted_prompt: str,
+        model_response: str,
+        last_response: Optional[str],
+        unit_tests: Optional[List[Tuple]],
+        cur_try: int,
+    ) -> Tuple[Optional[Callable], str]:
+        """
+        Parses and tests the response of a try, shared by the synchronous and
+        asynchronous retry loops.
+
+        Returns:
+            Tuple[Optional[Callable], str]: The function, if it passed, and the prompt
+                to query the model with on the next try otherwise.
+
+        Raises:
+            TooManyRetries: If the response is the same as the last try's.
+        """
+        function, parse_error = self._parse_and_test(
+            model_response, unit_tests, cur_try
+        )
+        if function is not None:
+            return function, formatted_prompt
 
-            else:
-                raise TooManyRetries(f"{n_retries=} exceeded.")
+        # The same response twice in a row means that the model answers the prompt
+        # deterministically, so the remaining tries would only repeat it
+        if model_response == last_response:
+            raise TooManyRetries(
+                f"Try #{cur_try} got the same response as the last try."
+            )
 
-        # Cache the response
-        with CacheHandler("r") as f:
-            new_cache = json.load(f)
+        # A new seed alone rarely fixes a response that could not be parsed, so the
+        # reason is also fed back to the model
+        if parse_error is not None:
+            return None, formatted_prompt + _PARSE_FEEDBACK.format(error=parse_error)
+        return None, formatted_prompt
 
-        new_cache[prompt] = {
-            "model_response": model_response,
-            "sampling_params": asdict(sampling_params),
-            "parser": parser.__class__.__name__,
+    def _query(self, formatted_prompt: str, sampling_params: SamplingParams) -> str:
+        """
+        Queries the model, streaming the response when `stream` is set. The stream is
+        closed, aborting the generation, once a complete code block has arrived.
+        """
+        if not self.stream:
+            return self.client.query(formatted_prompt, sampling_params=sampling_params)
+
+        chunks = self.client.query_stream(
+            formatted_prompt, sampling_params=sampling_params
+        )
+        parts = []
+        try:
+            for chunk in chunks:
+                parts.append(chunk)
+                if self._code_complete(chunk, parts):
+                    break
+        finally:
+            chunks.close()
+        return "".join(parts)
+
+    async def _aquery(
+        self, formatted_prompt: str, sampling_params: SamplingParams
+    ) -> str:
+        """
+        Asynchronous counterpart of `_query`.
+        """
+        if not self.stream:
+            return await self.client.aquery(
+                formatted_prompt, sampling_params=sampling_params
+            )
+
+        chunks = self.client.aquery_stream(
+            formatted_prompt, sampling_params=sampling_params
+        )
+        parts = []
+        try:
+            async for chunk in chunks:
+                parts.append(chunk)
+                if self._code_complete(chunk, parts):
+                    break
+        finally:
+            await chunks.aclose()
+        return "".join(parts)
+
+    def _code_complete(self, chunk: str, parts: List[str]) -> bool:
+        # A code block can only have ended with a chunk holding part of a fence, a tag, or
+        # a line break, so the response is only scanned again then
+        if "`" not in chunk and ">" not in chunk and "\n" not in chunk:
+            return False
+        return _has_complete_code("".join(parts))
+
+    def format_prompt(
+        self,
+        prompt: str,
+        input_types: Optional[List] = None,
+        output_types: Optional[List] = None,
+        unit_tests: Optional[List[Tuple]] = None,
+    ) -> str:
+        """
+        Formats the prompt that is sent to the model to define a function.
+
+        Args:
+            prompt (str): The prompt describing the function to be defined.
+            input_types (Optional[List]): A list of input types for the function.
+            output_types (Optional[List]): A list of output types for the function.
+            unit_tests (Optional[List[Tuple]]): A list of tuples for unit testing
+                the function, where each tuple contains input(s) and expected output.
+
+        Returns:
+            str: The prompt template applied to the arguments.
+        """
+        return self.prompt_template.apply(
+            prompt=prompt,
+            object_type="function",
+            input_types=input_types,
+            output_types=output_types,
+            unit_tests=unit_tests,
+        )
+
+    def parse_and_test(
+        self,
+        model_response: str,
+        unit_tests: Optional[List[Tuple]],
+        cur_try: int = 0,
+    ) -> Optional[Callable]:
+        """
+        Parses a function out of a model response and runs it against the unit tests.
+
+        Args:
+            model_response (str): The response of the model to a formatted prompt.
+            unit_tests (Optional[List[Tuple]]): A list of tuples for unit testing
+                the function, where each tuple contains input(s) and expected output.
+            cur_try (int): The number of the current try, used for logging.
+
+        Returns:
+            Optional[Callable]: The parsed function, or None if parsing or any of
+                the unit tests failed, in which case the reason is logged.
+        """
+        return self._parse_and_test(model_response, unit_tests, cur_try)[0]
+
+    def _parse_and_test(
+        self,
+        model_response: str,
+        unit_tests: Optional[List[Tuple]],
+        cur_try: int,
+    ) -> Tuple[Optional[Callable], Optional[str]]:
+        # Also returns why parsing failed, if it did, to be fed back to the model
+        logging.debug(f"Model response: {model_response}")
+        try:
+            function = self.parser.parse_function(model_response)
+        except SyntaxError as e:
+            # retry if parsing fails
+            logging.warning(f"Try #{cur_try}, function parsing failed: {e}")
+            return None, f"function parsing failed: {e}"
+        except NothingToParseError as e:
+            logging.warning(f"Try #{cur_try}, {e}")
+            logging.debug(
+                f"No function found in the following model response:\n{model_response}"
+            )
+            return None, str(e)
+
+        if unit_tests:
+            unit_test_results = self.unit_test(
+                function, unit_tests, source=model_response, parser=self.parser
+            )
+            logging.debug(f"Unit test results: {unit_test_results}")
+            if failures := [result for result in unit_test_results if result.failed]:
+                error_message = f"{len(failures)}/{len(unit_test_results)} test failed."
+                for result in failures:
+                    if result.error:
+                        error_message += (
+                            f"\n{result.x} -> {result.y}, got error {result.error}"
+                        )
+                    else:
+                        error_message += (
+                            f"\n{result.x} -> {result.y}, got {result.yhat} instead."
+                        )
+
+                # retry if any unit test fails
+                logging.warning(
+                    f"Try #{cur_try}, unit testing failed.\n{error_message}"
+                )
+                return None, None
+
+        return function, None
+
+    def _cache_key(self, formatted_prompt: str, sampling_params: SamplingParams) -> str:
+        """
+        Computes the key a function is cached under, from everything that determines how
+        it is generated. The formatted prompt covers the template and its arguments, and
+        the seed is left out as it is drawn anew for every try.
+        """
+        request = {
+            "prompt": formatted_prompt,
+            "model": self.client.model_name,
+            "sampling_params": dict(
+                sampling_params_dict(replace(sampling_params, seed=None))
+            ),
+            "parser": self.parser.__class__.__name__,
         }
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
 
-        with CacheHandler("w") as f:
-            json.dump(new_cache, f)
+    def _read_cache(self, cache_key: str) -> Optional[Function]:
+        """
+        Returns the function cached under the key, or None if it was never cached.
+        """
+        if (cached := self.cache.get(cache_key)) is None:
+            return None
 
+        model_response = cached["model_response"]
+        sampling_params = SamplingParams(**cached["sampling_params"])
+        parser, function = _parse_cached(cached["parser"], model_response)
         return Function(
             function=function,
             source=model_response,
@@ -224,3 +505,33 @@ class CodeLLM(CodeGenerator):
             sampling_params=sampling_params,
             parser=parser,
         )
+
+    def _write_cache(
+        self,
+        cache_key: str,
+        prompt: str,
+        function: Callable,
+        model_response: str,
+        sampling_params: SamplingParams,
+    ) -> Function:
+        """
+        Caches a freshly generated function and wraps it in a Function object.
+        """
+        self.cache.set(
+            cache_key,
+            {
+                # Only kept to make the cache easier to inspect
+                "prompt": prompt,
+                "model_response": model_response,
+                "sampling_params": asdict(sampling_params),
+                "parser": self.parser.__class__.__name__,
+            },
+        )
+
+        return Function(
+            function=function,
+            source=model_response,
+            model_name=self.client.model_name,
+            sampling_params=sampling_params,
+            parser=self.parser,
+        )
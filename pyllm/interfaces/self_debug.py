@@ -1,21 +1,18 @@
-import json
-import os
+import asyncio
 import logging
-import timeout_decorator
 
-from dataclasses import asdict, dataclass
-from typing import Optional, List, Tuple, Callable
-from random import randint
+from dataclasses import replace
+from typing import Any, Dict, Generator, Optional, List, Tuple
+from random import getrandbits
 from requests import RequestException
 from enum import Enum
 
-from pyllm.clients import Client, OpenAIChatClient
+from pyllm.clients import Client, OpenAIChatClient, bypass_cache
 from pyllm.parsers import Parser, RegExParser
 from pyllm.templates import PromptTemplate
 from pyllm.utils.exceptions import TooManyRetries, NothingToParseError
 from pyllm.interfaces import CodeGenerator, UnitTestResult
 from pyllm.utils.types import SamplingParams, Function
-from pyllm.utils.caching import CacheHandler
 from pyllm.utils.registry import METHOD_REGISTRY
 
 SELF_DEBUG_TEMPLATE = """Define a function for completing the following task in Python:
@@ -37,6 +34,20 @@ class FeedbackMode(str, Enum):
     UT_TRACE = "ut+trace"
 
 
+def _advance(
+    conversation: Generator, response: Optional[str], error: Optional[Exception]
+) -> Tuple[bool, Any]:
+    # Sends the response or error into the conversation, returning whether it has
+    # finished along with either its next query or the function it returned. A
+    # StopIteration can't be raised through a future, so it is caught here.
+    try:
+        if error is None:
+            return False, conversation.send(response)
+        return False, conversation.throw(error)
+    except StopIteration as e:
+        return True, e.value
+
+
 class SelfDebugLLM(CodeGenerator):
     def __init__(
         self,
@@ -44,11 +55,18 @@ class SelfDebugLLM(CodeGenerator):
         client: Optional[Client] = None,
         parser: Optional[Parser] = None,
         prompt_template: Optional[PromptTemplate] = None,
+        draft_client: Optional[Client] = None,
     ):
         if client is None:
             client = OpenAIChatClient()
         self.client = client
 
+        # Queried instead of the client for the turns that only ask the model to fix or
+        # confirm its own code, which a cheaper, faster model is usually good enough for
+        if draft_client is None:
+            draft_client = client
+        self.draft_client = draft_client
+
         if parser is None:
             parser = RegExParser()
         self.parser = parser
@@ -65,13 +83,11 @@ class SelfDebugLLM(CodeGenerator):
         feedback = "The code above fails for the following unit test(s):\n"
         for failure in failures:
             if failure.error:
-                feedback += "{x} -> {y}, raised an error {error}\n".format(
-                    **failure.__dict__
+                feedback += (
+                    f"{failure.x} -> {failure.y}, raised an error {failure.error}\n"
                 )
             else:
-                feedback += "{x} -> {y}, got {yhat} instead\n".format(
-                    **failure.__dict__
-                )
+                feedback += f"{failure.x} -> {failure.y}, got {failure.yhat} instead\n"
         if with_trace:
             feedback += f"Trace the execution of the function on input {failure.x}"
         else:
@@ -87,102 +103,148 @@ class SelfDebugLLM(CodeGenerator):
         n_retries: int = 1,
         sampling_params: SamplingParams = SamplingParams(),
     ) -> Function:
-        messages: List = [
-            {"role": "system", "content": "You are an expert programming assistant"},
-            {
-                "role": "user",
-                "content": self.prompt_template.apply(prompt, unit_tests=unit_tests),
-            },
-        ]
+        conversation = self._converse(
+            prompt, unit_tests, max_turns, n_retries, sampling_params
+        )
+        response, error = None, None
+        while True:
+            done, step = _advance(conversation, response, error)
+            if done:
+                return step
+
+            client, query = step
+            try:
+                with bypass_cache(not use_cached):
+                    response, error = client.query(**query), None
+            except RequestException as e:
+                response, error = None, e
+
+    async def adef_function(
+        self,
+        prompt: str,
+        unit_tests: List[Tuple],
+        max_turns: int = 2,
+        use_cached: bool = True,
+        n_retries: int = 1,
+        sampling_params: SamplingParams = SamplingParams(),
+    ) -> Function:
+        """
+        Asynchronous counterpart of `def_function`, taking the same arguments.
+
+        Every turn's query is awaited through the client's `aquery`, so the
+        conversations of many functions can be carried out on a single event loop.
+        The conversation is advanced in the loop's default executor, as doing so
+        runs the unit tests, which would otherwise block the loop.
+        """
+        loop = asyncio.get_running_loop()
+        conversation = self._converse(
+            prompt, unit_tests, max_turns, n_retries, sampling_params
+        )
+        response, error = None, None
+        while True:
+            done, step = await loop.run_in_executor(
+                None, _advance, conversation, response, error
+            )
+            if done:
+                return step
+
+            client, query = step
+            try:
+                with bypass_cache(not use_cached):
+                    response, error = await client.aquery(**query), None
+            except RequestException as e:
+                response, error = None, e
+
+    async def arelease(self):
+        for client in dict.fromkeys((self.client, self.draft_client)):
+            await client.arelease()
+
+    def _converse(
+        self,
+        prompt: str,
+        unit_tests: List[Tuple],
+        max_turns: int,
+        n_retries: int,
+        sampling_params: SamplingParams,
+    ) -> Generator[Tuple[Client, Dict], str, Function]:
+        # Carries out the conversation without doing any I/O. Every query to the model is
+        # yielded as the client to send it to and the arguments of its `query`, and its
+        # response or error is sent back in, so that the same conversation can be driven
+        # synchronously or asynchronously.
+        task = self.prompt_template.apply(prompt, unit_tests=unit_tests)
 
         for cur_try in range(n_retries):
-            seed = randint(0, 2**62)
-            sampling_params.seed = seed
+            # A seed given by the caller is kept for the first try, so that it is
+            # reproducible, while later tries need a different conversation
+            if cur_try > 0 or sampling_params.seed is None:
+                sampling_params = replace(sampling_params, seed=getrandbits(62))
             logging.debug(f"Try {cur_try}")
 
-            success_feedback = False
-            success_turn_function = None
+            # Every try starts a new conversation
+            messages: List = [
+                {
+                    "role": "system",
+                    "content": "You are an expert programming assistant",
+                },
+                {"role": "user", "content": task},
+            ]
+            # The last function that passed all unit tests, once one has
+            passed = None
             for turn in range(max_turns):
                 logging.debug(f"Turn {turn}")
+                # Only the first generation and detailed feedback need the full model
+                if passed is not None or (
+                    turn > 0 and self.feedback_mode == FeedbackMode.SIMPLE
+                ):
+                    client = self.draft_client
+                else:
+                    client = self.client
+
+                # Any failure ends the try, after which a function that passed the unit
+                # tests before the model was asked to confirm it is still returned
                 try:
-                    if success_feedback:
-                        success_turn_model_response = self.client.query(
-                            messages=messages, sampling_params=sampling_params
-                        )
-                        messages.append(
-                            {
-                                "role": "assistant",
-                                "content": success_turn_model_response,
-                            }
-                        )
-                    else:
-                        model_response = self.client.query(
-                            messages=messages, sampling_params=sampling_params
-                        )
-                        messages.append(
-                            {"role": "assistant", "content": model_response}
-                        )
-
-                    logging.debug(f"Model response: {model_response}")
+                    model_response = yield client, {
+                        "messages": messages,
+                        "sampling_params": sampling_params,
+                    }
                 except RequestException as e:
-                    # retry if server fails to give 200 response
-                    error_message = json.loads(e.args[0].decode())
-                    logging.warning(
-                        f"Try #{cur_try}, model query failed: {error_message}"
-                    )
-                    if not success_feedback:
-                        break
+                    self._log_request_error(e, cur_try)
+                    break
+                messages.append({"role": "assistant", "content": model_response})
+                logging.debug(f"Model response: {model_response}")
 
                 try:
-                    if success_feedback:
-                        success_turn_function = self.parser.parse_function(
-                            model_response
-                        )
-                    else:
-                        function = self.parser.parse_function(model_response)
+                    function = self.parser.parse_function(model_response)
                 except SyntaxError as e:
                     # retry if parsing fails
-                    error_message = e.msg
                     logging.warning(f"Try #{cur_try}, function parsing failed: {e}")
-                    if not success_feedback:
-                        break
+                    break
                 except NothingToParseError as e:
                     logging.warning(f"Try #{cur_try}, {e}")
                     logging.debug(
                         f"No function found in the following model response:\n{model_response}"
                     )
-                    if not success_feedback:
-                        break
-
-                # If one of the unit tests fails, return the function generated at the previous turn (already validated)
-                if success_feedback and success_turn_function:
-                    unit_test_results = self.unit_test(
-                        success_turn_function, unit_tests=unit_tests
-                    )
-                    for test in unit_test_results:
-                        if test.failed:
-                            return Function(
-                                function=function,
-                                source=model_response,
-                                model_name=self.client.model_name,
-                                sampling_params=sampling_params,
-                                parser=self.parser,
-                            )
-
-                    return Function(
-                        function=success_turn_function,
-                        source=success_turn_model_response,
-                        model_name=self.client.model_name,
-                        sampling_params=sampling_params,
-                        parser=self.parser,
-                    )
+                    break
 
-                unit_test_results = self.unit_test(function, unit_tests)
+                unit_test_results = self.unit_test(
+                    function, unit_tests, source=model_response, parser=self.parser
+                )
                 failures = [test for test in unit_test_results if test.failed]
 
-                # If all unit tests passed, go into the last success feedback turn
                 if not failures:
-                    success_feedback = True
+                    # The function the model confirmed, or fixed without breaking it,
+                    # is final
+                    confirmed = passed is not None
+                    passed = Function(
+                        function=function,
+                        source=model_response,
+                        model_name=client.model_name,
+                        sampling_params=sampling_params,
+                        parser=self.parser,
+                    )
+                    if confirmed:
+                        break
+                    # Otherwise, go into the last success feedback turn
                     messages.append(
                         {
                             "role": "user",
@@ -191,6 +253,10 @@ class SelfDebugLLM(CodeGenerator):
                     )
                     continue
 
+                # The function generated at the previous turn was already validated
+                if passed is not None:
+                    break
+
                 if self.feedback_mode == FeedbackMode.SIMPLE:
                     messages.append(
                         {
@@ -211,14 +277,12 @@ class SelfDebugLLM(CodeGenerator):
                         }
                     )
                     try:
-                        explanation = self.client.query(
-                            messages=messages, sampling_params=sampling_params
-                        )
+                        explanation = yield self.client, {
+                            "messages": messages,
+                            "sampling_params": sampling_params,
+                        }
                     except RequestException as e:
-                        error_message = json.loads(e.args[0].decode())
-                        logging.warning(
-                            f"Try #{cur_try}, model query failed: {error_message}"
-                        )
+                        self._log_request_error(e, cur_try)
                         break
                     feedback = self._get_unit_test_feedback(failures)
                     messages += [
@@ -231,19 +295,21 @@ class SelfDebugLLM(CodeGenerator):
 
                     messages.append({"role": "user", "content": feedback})
                     try:
-                        trace = self.client.query(
-                            messages=messages, sampling_params=sampling_params
-                        )
+                        trace = yield self.client, {
+                            "messages": messages,
+                            "sampling_params": sampling_params,
+                        }
                     except RequestException as e:
-                        error_message = json.loads(e.args[0].decode())
-                        logging.warning(
-                            f"Try #{cur_try}, model query failed: {error_message}"
-                        )
+                        self._log_request_error(e, cur_try)
                         break
                     messages += [
                         {"role": "assistant", "content": trace},
                         {"role": "user", "content": "Please fix the Python code."},
                     ]
+
+            # Also reached when the turns ran out right after the unit tests passed
+            if passed is not None:
+                return passed
         raise TooManyRetries(f"{n_retries=} exceeded.")
 
 
@@ -254,8 +320,11 @@ class SelfDebugLLMSimple(SelfDebugLLM):
         client: Optional[Client] = None,
         parser: Optional[Parser] = None,
         prompt_template: Optional[PromptTemplate] = None,
+        draft_client: Optional[Client] = None,
     ):
-        super().__init__(FeedbackMode.SIMPLE, client, parser, prompt_template)
+        super().__init__(
+            FeedbackMode.SIMPLE, client, parser, prompt_template, draft_client
+        )
 
 
 @METHOD_REGISTRY.register("self-debug-ut")
@@ -265,8 +334,9 @@ class SelfDebugLLMUT(SelfDebugLLM):
         client: Optional[Client] = None,
         parser: Optional[Parser] = None,
         prompt_template: Optional[PromptTemplate] = None,
+        draft_client: Optional[Client] = None,
     ):
-        super().__init__(FeedbackMode.UT, client, parser, prompt_template)
+        super().__init__(FeedbackMode.UT, client, parser, prompt_template, draft_client)
 
 
 @METHOD_REGISTRY.register("self-debug-ut-expl")
@@ -276,8 +346,11 @@ class SelfDebugLLMUTExpl(SelfDebugLLM):
         client: Optional[Client] = None,
         parser: Optional[Parser] = None,
         prompt_template: Optional[PromptTemplate] = None,
+        draft_client: Optional[Client] = None,
     ):
-        super().__init__(FeedbackMode.UT_EXPL, client, parser, prompt_template)
+        super().__init__(
+            FeedbackMode.UT_EXPL, client, parser, prompt_template, draft_client
+        )
 
 
 @METHOD_REGISTRY.register("self-debug-ut-trace")
@@ -287,5 +360,8 @@ class SelfDebugLLMUTExpl(SelfDebugLLM):
         client: Optional[Client] = None,
         parser: Optional[Parser] = None,
         prompt_template: Optional[PromptTemplate] = None,
+        draft_client: Optional[Client] = None,
     ):
-        super().__init__(FeedbackMode.UT_TRACE, client, parser, prompt_template)
+        super().__init__(
+            FeedbackMode.UT_TRACE, client, parser, prompt_template, draft_client
+        )
@@ -1,17 +1,85 @@
-import ast
 import re
-from typing import Callable
+import ast
+import functools
+
+from types import CodeType
+from typing import Callable, List, Tuple
 
 from pyllm.parsers import Parser
 from pyllm.utils.exceptions import NothingToParseError
 
+_IMPORT_RE = re.compile(
+    r"(from [\w\.]+ import [\w\., ]+)|(import [\w\.]+(?:, [\w\.]+)*)", re.MULTILINE
+)
+# Indented lines are matched from their first non-whitespace character, so that the
+# whitespace can't be split between `\s+` and `.+` in quadratically many ways when a
+# line doesn't end the way the pattern expects
+_FUNCTION_RE = re.compile(r"(def .+:\n(?:\s+\S.*\n)*)", re.MULTILINE)
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_code(
+    input_string: str,
+) -> Tuple[CodeType, Tuple[Tuple[CodeType, Tuple[str, ...]], ...]]:
+    # Parsing and compiling only depend on the response, so a response that is parsed
+    # again, such as on a retry, only has its code executed. Returns the code of all the
+    # import statements, and the code of the function definitions with the names of the
+    # functions it defines, in the order they are defined in
+    import_tree, function_trees = _parse_code(input_string)
+    import_code = compile(import_tree, filename="import_statements", mode="exec")
+    function_codes = tuple(
+        (
+            compile(parsed_ast, filename="compiled_generated_code", mode="exec"),
+            tuple(
+                node.name
+                for node in ast.walk(parsed_ast)
+                if isinstance(node, ast.FunctionDef)
+            ),
+        )
+        for parsed_ast in function_trees
+    )
+    return import_code, function_codes
+
+
+def _parse_code(input_string: str) -> Tuple[ast.Module, List[ast.Module]]:
+    # Responses that are nothing but code are parsed in one go, while code surrounded
+    # by prose has its imports and functions extracted by the patterns
+    try:
+        tree = ast.parse(input_string, mode="exec")
+    except SyntaxError:
+        tree = None
+
+    if tree is not None and any(
+        isinstance(node, ast.FunctionDef) for node in tree.body
+    ):
+        imports = [
+            node for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom))
+        ]
+        functions = [node for node in tree.body if isinstance(node, ast.FunctionDef)]
+        return (
+            ast.Module(body=imports, type_ignores=[]),
+            [ast.Module(body=functions, type_ignores=[])],
+        )
+
+    # The import statements are gathered into a single module, to be executed at once
+    imports = [
+        node
+        for match in _IMPORT_RE.finditer(input_string)
+        for node in ast.parse(match.group(), mode="exec").body
+    ]
+    function_trees = [
+        ast.parse(match.group(), mode="exec")
+        for match in _FUNCTION_RE.finditer(input_string)
+    ]
+    return ast.Module(body=imports, type_ignores=[]), function_trees
+
 
 class RegExParser(Parser):
     """
     A parser that extracts Python code blocks from an input string using regular expressions.
 
     This parser specifically focuses on identifying import statements and function definitions
-    within the provided string. It dynamically executes these code blocks within the current
+    within the provided string. It dynamically executes these code blocks within a fresh
     namespace, allowing for the runtime definition of functions based on language model output
     or other dynamically generated Python code.
     """
@@ -20,10 +88,10 @@ class RegExParser(Parser):
         """
         Parses and dynamically executes Python code to define functions from the input string.
 
-        This method uses regular expressions to extract import statements and function
-        definitions from the provided input string. It then executes these statements and
-        definitions within the current namespace, effectively defining any functions included
-        in the input.
+        This method extracts import statements and function definitions from the provided
+        input string, by parsing it whole when it is nothing but code, or with regular
+        expressions otherwise. It then executes these statements and definitions within
+        a namespace of their own, effectively defining any functions included in the input.
 
         Args:
             input_string (str): The input string containing the Python code to be parsed
@@ -42,51 +110,23 @@ class RegExParser(Parser):
             NothingToParseError: If no code was able to be parsed from the input
         """
         # Escape all \ characters
-        input_string = re.sub(r"\\", r"\\\\", input_string)
-
-        # import all needed packages provided by the LLM
-        import_statements = []
-        import_pattern = (
-            r"(from [\w\.]+ import [\w\., ]+)|(import [\w\.]+(?:, [\w\.]+)*)"
-        )
-        matches = re.finditer(import_pattern, input_string, re.MULTILINE)
+        input_string = input_string.replace("\\", "\\\\")
 
-        for match in matches:
-            block = match.group()
-            import_statements.append(block)
+        import_code, function_codes = _compile_code(input_string)
 
-        # Share the current namespace
-        namespace = globals()
+        # Every response gets a namespace of its own, which its functions keep as their
+        # globals, so that neither this module nor other responses are polluted by it
+        namespace = {"__builtins__": __builtins__}
 
-        for import_statement in import_statements:
-            parsed_ast = ast.parse(import_statement, mode="exec")
-            code = compile(parsed_ast, filename="import_statements", mode="exec")
-            exec(code, namespace)
+        # import all needed packages provided by the LLM
+        exec(import_code, namespace)
 
         # Define all the functions in the LLM output
-        function_blocks = []
-        function_pattern = r"(def .+:\n(?:\s+.+\n)*)"
-        matches = re.finditer(function_pattern, input_string, re.MULTILINE)
-
-        for match in matches:
-            block = match.group()
-            function_blocks.append(block)
-
-        for code_str in function_blocks:
-            parsed_ast = ast.parse(code_str, mode="exec")
-
-            # Keep track of names of parsed functions
-            function_names = set()
-            for node in ast.walk(parsed_ast):
-                if isinstance(node, ast.FunctionDef):
-                    function_names.add(node.name)
-
-            # Compile the code and execute it
-            code = compile(parsed_ast, filename="compiled_generated_code", mode="exec")
+        for code, function_names in function_codes:
             exec(code, namespace)
             # Return the first function that has a detected name
-            for name, value in namespace.items():
-                if name in function_names:
-                    return value
+            for name in function_names:
+                if name in namespace:
+                    return namespace[name]
 
         raise NothingToParseError("No function was able to be parsed.")
@@ -1,9 +1,41 @@
 import jinja2
+import functools
 
-from typing import Optional, List, Literal, Tuple
+from typing import Any, Dict, Hashable, Optional, List, Literal, Tuple
 
 from pyllm.templates.jinja import DEFAULT_FUNCTION_JINJA_TEMPLATE
 
+_ENVIRONMENT = jinja2.Environment()
+# The number of rendered prompts kept by every template
+_MAX_RENDERED = 128
+# Values whose equality implies they render the same. Sets are left out, as equal sets
+# may be iterated in different orders
+_SCALAR_TYPES = (str, int, float, complex, bool, bytes, type(None), type)
+
+
+class _Unfreezable(Exception):
+    pass
+
+
+def _freeze(value: Any) -> Hashable:
+    # Tagged with the type, so that equal values rendered differently, such as 1, 1.0
+    # and True, get different keys. Floats are keyed by their repr, as 0.0 == -0.0.
+    if isinstance(value, (float, complex)):
+        return type(value), repr(value)
+    if isinstance(value, _SCALAR_TYPES):
+        return type(value), value
+    if isinstance(value, (list, tuple)):
+        return type(value), tuple(map(_freeze, value))
+    if isinstance(value, dict):
+        return dict, tuple((_freeze(k), _freeze(v)) for k, v in value.items())
+    raise _Unfreezable
+
+
+@functools.lru_cache(maxsize=None)
+def _compile(jinja_template_string: str) -> jinja2.Template:
+    # Templates are immutable once compiled, so instances using the same string share one
+    return _ENVIRONMENT.from_string(jinja_template_string)
+
 
 class PromptTemplate:
     """
@@ -19,14 +51,15 @@ class PromptTemplate:
 
     def __init__(self, jinja_template_string=DEFAULT_FUNCTION_JINJA_TEMPLATE):
         """
-        Initializes the PromptTemplate with a Jinja2 environment and template.
+        Initializes the PromptTemplate with a Jinja2 template, compiled only the first
+        time a given template string is used.
 
         Args:
             jinja_template_string (str): A string containing the Jinja2 template for
                 generating prompts. Defaults to DEFAULT_FUNCTION_JINJA_TEMPLATE.
         """
-        environment = jinja2.Environment()
-        self.jinja_template = environment.from_string(jinja_template_string)
+        self.jinja_template = _compile(jinja_template_string)
+        self._rendered: Dict[Hashable, str] = {}
 
     def apply(
         self,
@@ -41,7 +74,7 @@ class PromptTemplate:
         Applies the Jinja2 template to the given parameters to generate a prompt.
 
         This method renders a prompt using the initialized Jinja2 template with the specified
-        parameters.
+        parameters. Prompts recently rendered from the same parameters are reused.
 
         Args:
             prompt (str): The base prompt to which the template will be applied.
@@ -55,10 +88,24 @@ class PromptTemplate:
         Returns:
             str: The generated prompt after applying the template with the provided parameters.
         """
-        return self.jinja_template.render(
+        render = functools.partial(
+            self.jinja_template.render,
             prompt=prompt,
             object_type=object_type,
             input_types=input_types,
             output_types=output_types,
             unit_tests=unit_tests,
         )
+        # The parameters may be unhashable lists, so they are keyed by their values
+        # frozen into tuples. Prompts with values that can't be are always rendered.
+        try:
+            key = _freeze((prompt, object_type, input_types, output_types, unit_tests))
+        except _Unfreezable:
+            return render()
+
+        if (rendered := self._rendered.get(key)) is None:
+            rendered = render()
+            if len(self._rendered) >= _MAX_RENDERED:
+                self._rendered.clear()
+            self._rendered[key] = rendered
+        return rendered
@@ -1,72 +1,168 @@
 import os
-import json
+import orjson
+import sqlite3
+import threading
+
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
 
-from filelock import FileLock
 from appdirs import user_cache_dir
 
-os.makedirs(user_cache_dir("PyLLM"), exist_ok=True)
+# Shared by every persistent cache, and resolved once as appdirs inspects the platform
+CACHE_DIR = user_cache_dir("PyLLM")
 
 
-class CacheHandler:
+class SQLiteCache:
     """
-    Manages access to a cache file with thread-safe read and write operations.
+    A persistent key-value store backed by a single SQLite table.
 
-    This class ensures that the cache file is created if it doesn't exist and
-    handles the locking mechanism to avoid concurrent write conflicts.
+    Reads and writes only touch the entry they concern, rather than the whole store.
+    Values are stored as JSON, serialized with orjson. Every thread gets its own
+    connection to the database, which runs in WAL mode so that readers are never
+    blocked by a writer.
 
     Attributes:
-        _CACHE_FILE (str): The path to the cache file used for storing function
-            definitions and responses.
+        path (str): The path to the SQLite database file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # The directory is only created once the cache is used, rather than on import
+            if directory := os.path.dirname(self.path):
+                os.makedirs(directory, exist_ok=True)
+            # Autocommit mode, every statement is its own transaction
+            connection = sqlite3.connect(self.path, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            )
+            self._local.connection = connection
+        return connection
+
+    def get(self, key: str, default: Optional[Any] = None) -> Any:
+        """
+        Returns the value stored under the key, or `default` if there is none.
+        """
+        row = self._connection.execute(
+            "SELECT value FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return default
+        # Entries written before orjson was used are text, which it reads all the same
+        return orjson.loads(row[0])
+
+    def set(self, key: str, value: Any):
+        """
+        Stores a JSON-serializable value under the key, replacing any previous one.
+        """
+        self._connection.execute(
+            "INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)",
+            (key, orjson.dumps(value)),
+        )
+
+    def __contains__(self, key: str) -> bool:
+        return (
+            self._connection.execute(
+                "SELECT 1 FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            is not None
+        )
+
 
-    Args:
-        mode (str): The mode in which to open the cache file ('r' for read,
-            'w' for write, etc.). Defaults to 'r'.
+class TieredCache(SQLiteCache):
     """
+    A `SQLiteCache` fronted by a bounded in-memory LRU, so that entries persist across
+    runs while those read or written within a process are served without touching the
+    disk.
 
-    _CACHE_FILE = os.path.join(user_cache_dir("PyLLM"), "cached_functions.json")
+    Attributes:
+        maxsize (int): The maximum number of entries kept in memory.
+    """
 
-    def __init__(self, mode: str = "r"):
-        self.mode = mode
+    _shared: Dict[Tuple[type, Optional[str]], "TieredCache"] = {}
+    _shared_lock = threading.Lock()
 
-    def __enter__(self):
+    def __init__(self, path: str, maxsize: int = 1024):
+        super().__init__(path)
+        self.maxsize = maxsize
+        self._memory: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, path: Optional[str] = None) -> "TieredCache":
+        """
+        Returns the process-wide instance of the cache for the path, creating it on first
+        use, so that everything using the same cache also shares its in-memory entries.
         """
-        Manages access to a cache file with thread-safe read and write operations.
+        with cls._shared_lock:
+            if (cache := cls._shared.get((cls, path))) is None:
+                cache = cls._shared[cls, path] = cls() if path is None else cls(path)
+            return cache
 
-        This class ensures that the cache file is created if it doesn't exist and
-        handles the locking mechanism to avoid concurrent write conflicts.
+    def get(self, key: str, default: Optional[Any] = None) -> Any:
+        """
+        Returns the value stored under the key, or `default` if there is none.
+        """
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
 
-        Attributes:
-            _CACHE_FILE (str): The path to the cache file used for storing function
-                definitions and responses.
+        value = super().get(key)
+        if value is None:
+            return default
+        self._remember(key, value)
+        return value
 
-        Args:
-            mode (str): The mode in which to open the cache file ('r' for read,
-                'w' for write, etc.). Defaults to 'r'.
+    def set(self, key: str, value: Any):
         """
-        self.lock = FileLock(f"{self._CACHE_FILE}.lock")
-        self.lock.acquire()
-        try:
-            if not os.path.exists(self._CACHE_FILE):
-                with open(self._CACHE_FILE, "w") as f:
-                    json.dump({}, f)
-            else:
-                try:
-                    with open(self._CACHE_FILE, "r") as f:
-                        json.load(f)
-                # If the file is corrupted, empty it
-                except json.JSONDecodeError:
-                    with open(self._CACHE_FILE, "w") as f:
-                        json.dump({}, f)
-        finally:
-            self.lock.release()
-
-        self.file = open(self._CACHE_FILE, self.mode)
-        return self.file
-
-    def __exit__(self, *_):
+        Stores a JSON-serializable value under the key, both in memory and on disk.
+        Storing the value the key already holds in memory skips the disk.
         """
-        Closes the cache file and releases the file lock on exiting the
-        context manager.
+        with self._lock:
+            if key in self._memory and self._memory[key] == value:
+                self._memory.move_to_end(key)
+                return
+        super().set(key, value)
+        self._remember(key, value)
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            if key in self._memory:
+                return True
+        return super().__contains__(key)
+
+    def _remember(self, key: str, value: Any):
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            if len(self._memory) > self.maxsize:
+                self._memory.popitem(last=False)
+
+
+class CacheHandler(TieredCache):
+    """
+    The persistent cache of generated functions, keyed by request.
+
+    Attributes:
+        _CACHE_FILE (str): The path to the database used by default for storing
+            function definitions and responses.
+    """
+
+    _CACHE_FILE = os.path.join(CACHE_DIR, "cached_functions.db")
+
+    def __init__(self, path: Optional[str] = None, maxsize: int = 1024):
+        """
+        Args:
+            path (Optional[str]): The path to the SQLite database the functions are
+                stored in. Defaults to a file in the user's cache directory.
+            maxsize (int): The maximum number of functions kept in memory.
         """
-        self.file.close()
-        self.lock.release()
+        super().__init__(path or self._CACHE_FILE, maxsize)
@@ -0,0 +1,150 @@
+import re
+import time
+import asyncio
+import threading
+
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Hashable, Mapping, Optional
+
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS_S = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls made with the same key into a single call.
+
+    The first caller for a key runs the function, while callers arriving with the same key
+    before it returns wait for it and share its result, or its exception. Once the call
+    returns, the next caller for the key runs the function again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight: Dict[Hashable, Future] = {}
+        self._ainflight: Dict[Hashable, asyncio.Future] = {}
+
+    def do(self, key: Hashable, function: Callable, *args, **kwargs) -> Any:
+        """
+        Calls `function(*args, **kwargs)`, unless a call with the same key is already
+        in flight on another thread, in which case its result is waited for and returned.
+        """
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = function(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    async def ado(
+        self, key: Hashable, function: Callable[..., Awaitable], *args, **kwargs
+    ) -> Any:
+        """
+        Asynchronous counterpart of `do`, awaiting `function(*args, **kwargs)` unless a
+        call with the same key is already in flight on the event loop. If the caller
+        running the call is cancelled, one of the callers waiting for it runs it instead.
+        """
+        while (future := self._ainflight.get(key)) is not None:
+            try:
+                # Shielded so that a cancelled follower doesn't cancel the leader's call
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # A cancelled leader hands the call over to the first of its followers
+                # to retry it, rather than cancelling them all along with it
+                if not future.cancelled():
+                    raise
+
+        future = self._ainflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await function(*args, **kwargs)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Only retrieved by followers, if there are any
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._ainflight[key]
+
+
+def parse_duration(duration: str) -> Optional[float]:
+    """
+    Parses a duration in the format of OpenAI's rate limit headers, such as '20ms', '1s',
+    or '6m0s'.
+
+    Returns:
+        Optional[float]: The duration in seconds, or None if it could not be parsed.
+    """
+    parts = _DURATION_RE.findall(duration)
+    if not parts or "".join(value + unit for value, unit in parts) != duration:
+        return None
+    return sum(float(value) * _DURATION_UNITS_S[unit] for value, unit in parts)
+
+
+class RateLimitGate:
+    """
+    Holds back requests while a server reports that its rate limit is exhausted.
+
+    Servers following OpenAI's convention report the number of requests left in the
+    current window, and the time until the window resets, in the
+    `x-ratelimit-remaining-requests` and `x-ratelimit-reset-requests` headers. Once no
+    requests are left, callers wait for the reset instead of sending requests that would
+    only be rejected with a 429.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reopens_at = 0.0
+
+    def update(self, headers: Mapping[str, str]):
+        """
+        Updates the gate from the headers of a response.
+        """
+        remaining = headers.get("x-ratelimit-remaining-requests")
+        reset = headers.get("x-ratelimit-reset-requests")
+        if remaining is None or reset is None or remaining.strip() != "0":
+            return
+        if (reset_s := parse_duration(reset)) is None:
+            return
+
+        with self._lock:
+            self._reopens_at = max(self._reopens_at, time.monotonic() + reset_s)
+
+    def delay(self) -> float:
+        """
+        Returns the number of seconds until requests may be sent again.
+        """
+        return max(0.0, self._reopens_at - time.monotonic())
+
+    def pause(self):
+        """
+        Blocks until requests may be sent again.
+        """
+        if (delay := self.delay()) > 0:
+            time.sleep(delay)
+
+    async def apause(self):
+        """
+        Asynchronous counterpart of `pause`.
+        """
+        if (delay := self.delay()) > 0:
+            await asyncio.sleep(delay)
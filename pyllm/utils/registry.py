@@ -1,4 +1,6 @@
 class Registry:
+    __slots__ = ("_classes_dict",)
+
     def __init__(self) -> None:
         self._classes_dict = {}
 
@@ -15,11 +17,9 @@ class Registry:
         return _register
 
     def build(self, name, *args, **kwargs):
-        key = name.lower()
-        if key not in self._classes_dict.keys():
+        cls = self._classes_dict.get(name.lower())
+        if cls is None:
             raise ValueError(f"Type '{name}' is not registered.")
-
-        cls = self._classes_dict[key]
         return cls(*args, **kwargs)
 
     def __contains__(self, key: str):
@@ -28,7 +28,8 @@ class Registry:
         return key.lower() in self._classes_dict
 
     def __getitem__(self, key: str):
-        return self._classes_dict[key]
+        # Keys are registered lowercase, as in `build` and `__contains__`
+        return self._classes_dict[key.lower()]
 
 
 CLIENT_REGISTRY = Registry()
@@ -1,15 +1,24 @@
 import re
+import functools
 
-from dataclasses import dataclass
-from typing import Optional, Union, List, Callable
+from types import MappingProxyType
+from dataclasses import asdict, dataclass
+from typing import TYPE_CHECKING, Any, Mapping, Optional, Union, List, Callable
 
-from pyllm.parsers import Parser
+if TYPE_CHECKING:
+    from pyllm.parsers import Parser
 
+# The first function definition in a model response, followed by its indented body
+_FUNCTION_RE = re.compile(r"(def .+:.*\n(?:\s+\S.*\n)*)")
 
-@dataclass
+
+@dataclass(frozen=True)
 class SamplingParams:
     """
     Generation parameters following OpenAI's API
+
+    Instances are immutable and hashable, so use `dataclasses.replace` to derive
+    parameters with a different seed.
     """
 
     temperature: float = 1.0
@@ -21,6 +30,20 @@ class SamplingParams:
     frequency_penalty: float = 0.0
     seed: Optional[int] = None
 
+    def __post_init__(self):
+        # Lists of stop sequences are stored as tuples to keep instances hashable
+        if isinstance(self.stop, list):
+            object.__setattr__(self, "stop", tuple(self.stop))
+
+
+@functools.lru_cache(maxsize=8)
+def sampling_params_dict(sampling_params: SamplingParams) -> Mapping[str, Any]:
+    """
+    Returns the fields of the sampling parameters as a read-only mapping, memoized so that
+    queries reusing the same parameters don't convert them again.
+    """
+    return MappingProxyType(asdict(sampling_params))
+
 
 class Function:
     """
@@ -41,11 +64,14 @@ class Function:
             function.
     """
 
+    # One is created for every generated or cached function, so none carries a __dict__
+    __slots__ = ("function", "source", "model_name", "sampling_params", "parser")
+
     function: Callable
     source: str
     model_name: str
     sampling_params: SamplingParams
-    parser: Parser
+    parser: "Parser"
 
     def __init__(
         self,
@@ -53,7 +79,7 @@ class Function:
         source: str,
         model_name: str,
         sampling_params: SamplingParams,
-        parser: Parser,
+        parser: "Parser",
     ):
         """
         Args:
@@ -82,9 +108,7 @@ class Function:
             str: The first found function definition in the source code of the wrapped
                 function. If multiple functions are present, returns the first one.
         """
-
-        pattern = r"(def .+:.*\n(?:\s+.+\n)*)"
-        return re.findall(pattern, self.source)[0]
+        return _FUNCTION_RE.search(self.source).group(1)
 
     def __repr__(self):
         """
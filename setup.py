@@ -25,12 +25,13 @@ setup(
         "NLP",
     ],
     download_url=f"https://github.com/HishamYahya/PyLLM/archive/refs/tags/v{version}.tar.gz",
-    packages=find_packages(),
+    packages=find_packages(include=["pyllm", "pyllm.*"]),
     url="https://github.com/HishamYahya/PyLLM",
     install_requires=[
-        "filelock",
         "Jinja2",
         "Requests",
+        "httpx[http2]",
+        "orjson",
         "appdirs",
         "pytest",
         "datasets",
@@ -0,0 +1,401 @@
+import httpx
+import json
+import orjson
+import pytest
+import requests
+import asyncio
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from pyllm.clients import (
+    AzureChatClient,
+    OpenAIBatchClient,
+    OpenAIChatClient,
+    bypass_cache,
+)
+from pyllm.clients.cache import ResponseCache
+from pyllm.interfaces import CodeLLM
+from pyllm.utils.concurrency import SingleFlight
+from pyllm.utils.types import SamplingParams
+
+
+class MockResponse:
+    def __init__(self, content: str, status_code: int = 200, headers=None) -> None:
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.content = json.dumps(
+            {"choices": [{"message": {"content": content}}]}
+        ).encode()
+
+
+def test_cached_query(tmp_path):
+    client = OpenAIChatClient(api_key="test", cache=True)
+    client.response_cache = ResponseCache(str(tmp_path / "responses.db"))
+
+    requests = []
+
+    def post(url, **kwargs):
+        requests.append(kwargs)
+        return MockResponse(f"response {len(requests)}")
+
+    client._session.post = post
+
+    sampling_params = SamplingParams(seed=0)
+    assert client.query("prompt", sampling_params=sampling_params) == "response 1"
+    assert client.query("prompt", sampling_params=sampling_params) == "response 1"
+    assert len(requests) == 1
+
+    # A different request misses the cache
+    assert client.query("prompt", sampling_params=SamplingParams(seed=1)) == (
+        "response 2"
+    )
+
+    # Responses persist on disk
+    cache = ResponseCache(str(tmp_path / "responses.db"))
+    key = ResponseCache.key(
+        client.model_name, [{"role": "user", "content": "prompt"}], sampling_params
+    )
+    assert cache.get(key) == "response 1"
+
+
+def test_greedy_queries_are_cached_whatever_the_seed(tmp_path):
+    client = OpenAIChatClient(api_key="test", cache=True)
+    client.response_cache = ResponseCache(str(tmp_path / "responses.db"))
+
+    requests = []
+
+    def post(url, **kwargs):
+        requests.append(kwargs)
+        return MockResponse(f"response {len(requests)}")
+
+    client._session.post = post
+
+    # The seed is irrelevant when decoding greedily
+    for seed in range(3):
+        response = client.query(
+            "prompt", sampling_params=SamplingParams(temperature=0, seed=seed)
+        )
+        assert response == "response 1"
+    assert len(requests) == 1
+
+    # Unless asked to, clients cache nothing, greedy or not
+    client.cache = False
+    client.query("prompt", sampling_params=SamplingParams(temperature=0))
+    assert len(requests) == 2
+
+
+def test_cache_can_be_bypassed(tmp_path):
+    client = OpenAIChatClient(api_key="test", cache=True)
+    client.response_cache = ResponseCache(str(tmp_path / "responses.db"))
+
+    requests = []
+
+    def post(url, **kwargs):
+        requests.append(kwargs)
+        return MockResponse(f"response {len(requests)}")
+
+    client._session.post = post
+    sampling_params = SamplingParams(temperature=0)
+
+    assert client.query("prompt", sampling_params=sampling_params) == "response 1"
+    with bypass_cache():
+        assert client.query("prompt", sampling_params=sampling_params) == "response 2"
+    with bypass_cache(False):
+        assert client.query("prompt", sampling_params=sampling_params) == "response 1"
+
+    # Methods asked not to use cached functions don't replay cached responses either
+    responses = []
+
+    def post(url, **kwargs):
+        responses.append(kwargs)
+        return MockResponse("```python\ndef f():\n    return 1\n```")
+
+    class MockAsyncClient:
+        async def post(self, url, **kwargs):
+            return post(url, **kwargs)
+
+    client._session.post = post
+    client._get_async_client = MockAsyncClient
+    llm = CodeLLM(client=client)
+    for _ in range(2):
+        llm.def_function("f", use_cached=False, sampling_params=sampling_params)
+        asyncio.run(
+            llm.adef_function("f", use_cached=False, sampling_params=sampling_params)
+        )
+    assert len(responses) == 4
+
+
+class MockStreamedResponse:
+    status_code = 200
+    headers = {}
+
+    def __init__(self, chunks) -> None:
+        self._lines = [
+            b"data: "
+            + json.dumps(
+                {"choices": [{"index": 0, "delta": {"content": chunk}}]}
+            ).encode()
+            for chunk in chunks
+        ] + [b"data: [DONE]"]
+
+    def iter_lines(self):
+        return iter(self._lines)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        pass
+
+
+def test_streamed_query():
+    client = OpenAIChatClient(api_key="test")
+    client._session.post = lambda url, **kwargs: MockStreamedResponse(
+        ["def f():", "\n    return 1\n"]
+    )
+
+    chunks = list(client.query_stream("prompt", sampling_params=SamplingParams()))
+
+    assert chunks == ["def f():", "\n    return 1\n"]
+
+
+def test_concurrent_identical_queries_are_coalesced(tmp_path):
+    client = OpenAIChatClient(api_key="test", cache=True)
+    client.response_cache = ResponseCache(str(tmp_path / "responses.db"))
+
+    requests = []
+    release = threading.Event()
+
+    def post(url, **kwargs):
+        requests.append(kwargs)
+        release.wait(timeout=5)
+        return MockResponse("response")
+
+    client._session.post = post
+
+    sampling_params = SamplingParams(seed=0)
+    with ThreadPoolExecutor(4) as pool:
+        futures = [
+            pool.submit(client.query, "prompt", sampling_params=sampling_params)
+            for _ in range(4)
+        ]
+        time.sleep(0.1)
+        release.set()
+        responses = [future.result() for future in futures]
+
+    assert responses == ["response"] * 4
+    assert len(requests) == 1
+
+
+def test_async_query_retries_rate_limited_requests():
+    client = OpenAIChatClient(api_key="test")
+
+    responses = [
+        MockResponse("", status_code=429, headers={"retry-after": "0"}),
+        MockResponse("", status_code=503, headers={"retry-after": "0"}),
+        MockResponse("response"),
+    ]
+
+    class MockAsyncClient:
+        async def post(self, url, **kwargs):
+            return responses.pop(0)
+
+    client._get_async_client = MockAsyncClient
+    assert asyncio.run(client.aquery("prompt")) == "response"
+    assert not responses
+
+
+def test_async_query_retries_transport_errors():
+    client = OpenAIChatClient(api_key="test", max_retries=1)
+    client._retry_delay = lambda attempt, headers: 0
+
+    responses = [httpx.ConnectError("refused"), MockResponse("response")]
+
+    class MockAsyncClient:
+        async def post(self, url, **kwargs):
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+    client._get_async_client = MockAsyncClient
+    assert asyncio.run(client.aquery("prompt")) == "response"
+    assert not responses
+
+    # Once retries run out, the error is raised as the synchronous client raises it
+    responses = [httpx.ConnectError("refused"), httpx.ReadTimeout("timed out")]
+    with pytest.raises(requests.ConnectionError):
+        asyncio.run(client.aquery("other prompt"))
+    assert not responses
+
+
+@pytest.mark.parametrize(
+    "client",
+    [
+        OpenAIChatClient(api_key="test"),
+        AzureChatClient(url="https://test.openai.azure.com", api_key="test"),
+    ],
+)
+def test_spliced_body_matches_built_body(client):
+    messages = [{"role": "user", "content": "prompt"}]
+    sampling_params = SamplingParams(temperature=0.5, seed=0)
+
+    def assert_bodies_match():
+        body = orjson.loads(client._dump_body(messages, sampling_params))
+        assert body == client._build_body(messages, sampling_params)
+
+    assert_bodies_match()
+    # The body follows the model the client is pointed at
+    client.model_name = "other-model"
+    assert_bodies_match()
+
+
+def test_async_clients_are_closed_with_their_loop():
+    client = OpenAIChatClient(api_key="test")
+
+    async def open_client():
+        return client._get_async_client()
+
+    # A client left on a loop that is still open is closed on it once replaced
+    loop = asyncio.new_event_loop()
+    stale = loop.run_until_complete(open_client())
+
+    async def open_and_release():
+        aclient = client._get_async_client()
+        await client.arelease()
+        return aclient
+
+    released = asyncio.run(open_and_release())
+    loop.run_until_complete(asyncio.sleep(0.01))
+    loop.close()
+
+    assert stale.is_closed
+    assert released.is_closed
+    assert client._aclient is None
+
+
+def test_client_args_keep_string_parameters_as_strings():
+    from pyllm.evaluate import _parse_client_arg
+
+    assert _parse_client_arg(OpenAIChatClient, "api_key", "123") == "123"
+    assert _parse_client_arg(AzureChatClient, "deployment_id", "001") == "001"
+    assert _parse_client_arg(OpenAIChatClient, "max_connections", "4") == 4
+    assert _parse_client_arg(OpenAIChatClient, "http2", "False") is False
+    # Parameters passed on to a base class are found on it
+    assert _parse_client_arg(OpenAIBatchClient, "org_id", "1e3") == "1e3"
+    assert _parse_client_arg(OpenAIBatchClient, "poll_interval_s", "5") == 5
+
+
+def test_client_args_are_validated():
+    from pyllm.evaluate import _parse_client_arg
+
+    assert _parse_client_arg(AzureChatClient, "cache", "true") is True
+    assert _parse_client_arg(AzureChatClient, "cache", "FALSE") is False
+    with pytest.raises(ValueError):
+        _parse_client_arg(AzureChatClient, "cache", "yes please")
+    with pytest.raises(ValueError):
+        _parse_client_arg(OpenAIChatClient, "bogus", "3")
+
+
+def test_cancelled_leader_hands_over_coalesced_call():
+    flight = SingleFlight()
+    calls = []
+
+    async def call(n):
+        calls.append(n)
+        await asyncio.sleep(0.05)
+        return n
+
+    async def run():
+        leader = asyncio.ensure_future(flight.ado("key", call, 0))
+        await asyncio.sleep(0)
+        followers = [asyncio.ensure_future(flight.ado("key", call, n)) for n in (1, 2)]
+        await asyncio.sleep(0)
+        leader.cancel()
+        return await asyncio.gather(*followers)
+
+    # The first follower takes over, and the other waits for it
+    assert asyncio.run(run()) == [1, 1]
+    assert calls == [0, 1]
+
+
+class MockBatchResponse:
+    def __init__(self, content: bytes, status_code: int = 200) -> None:
+        self.status_code = status_code
+        self.content = content
+
+
+def test_batch_responses_are_mapped_to_their_requests():
+    client = OpenAIBatchClient(api_key="test", poll_interval_s=0)
+    uploads = []
+    statuses = iter(["validating", "in_progress", "completed"])
+
+    def request(method, url, **kwargs):
+        if url.endswith("v1/files"):
+            uploads.append(kwargs["files"]["file"][1])
+            return MockBatchResponse(b'{"id": "file-in"}')
+        status = next(statuses)
+        return MockBatchResponse(
+            json.dumps(
+                {"id": "batch", "status": status, "output_file_id": "file-out"}
+            ).encode()
+        )
+
+    def get(url, **kwargs):
+        assert url.endswith("v1/files/file-out/content")
+        # Results come back in any order, and failed requests have no response
+        lines = [
+            {
+                "custom_id": ids[2],
+                "response": {"status_code": 500, "body": {}},
+            },
+            {
+                "custom_id": ids[1],
+                "response": {
+                    "status_code": 200,
+                    "body": {"choices": [{"message": {"content": "second"}}]},
+                },
+            },
+            {"custom_id": ids[3], "response": None},
+            {
+                "custom_id": ids[0],
+                "response": {
+                    "status_code": 200,
+                    "body": {"choices": [{"message": {"content": "first"}}]},
+                },
+            },
+        ]
+        return MockBatchResponse(
+            b"\n".join(json.dumps(line).encode() for line in lines)
+        )
+
+    client._session.request = request
+    client._session.get = get
+
+    ids = [client.submit(f"prompt {i}") for i in range(4)]
+    responses = client.flush()
+
+    assert responses == {ids[0]: "first", ids[1]: "second"}
+    # All requests were uploaded in a single batch, in the order they were submitted
+    (upload,) = uploads
+    assert [json.loads(line)["custom_id"] for line in upload.splitlines()] == ids
+    # Nothing is left to send
+    assert client.flush() == {}
+
+
+def test_batch_query_raises_for_failed_batches():
+    client = OpenAIBatchClient(api_key="test", poll_interval_s=0)
+
+    def request(method, url, **kwargs):
+        # A stalled upload or poll would otherwise hang the flush
+        assert kwargs["timeout"]
+        if url.endswith("v1/files"):
+            return MockBatchResponse(b'{"id": "file-in"}')
+        return MockBatchResponse(b'{"id": "batch", "status": "failed"}')
+
+    client._session.request = request
+
+    with pytest.raises(requests.RequestException):
+        client.query("prompt")
@@ -0,0 +1,56 @@
+import pytest
+
+from pyllm.function_datasets.mbpp import _get_unit_tests
+
+
+def unit_tests(*tests):
+    return _get_unit_tests({"test_list": list(tests)})
+
+
+def test_mbpp_arguments_are_parsed_as_tuples():
+    assert unit_tests("assert add(1, 2) == 3", "assert first([1, 2]) == 1") == [
+        ((1, 2), 3),
+        ([1, 2], 1),
+    ]
+
+
+def test_mbpp_assertion_messages_are_ignored():
+    assert unit_tests('assert add(1, 2) == 3, "wrong sum"') == [((1, 2), 3)]
+
+
+def test_mbpp_float_and_set_outputs():
+    assert unit_tests("assert half(5) == 2.5") == [(5, 2.5)]
+    assert unit_tests("assert set(common([1, 2], [2, 3])) == set([2])") == [
+        (([1, 2], [2, 3]), {2})
+    ]
+
+
+def test_mbpp_values_that_are_not_literals_are_evaluated():
+    assert unit_tests("assert area(2) == 2 * 3.5") == [(2, 7.0)]
+    assert unit_tests("assert evens(4) == list(range(0, 4, 2))") == [(4, [0, 2])]
+
+
+def test_mbpp_comprehensions_are_evaluated():
+    assert unit_tests("assert f(3) == [x * 2 for x in range(3)]") == [(3, [0, 2, 4])]
+    assert unit_tests("assert f(2) == {i: i ** 2 for i in range(2)}") == [
+        (2, {0: 0, 1: 1})
+    ]
+
+
+@pytest.mark.parametrize(
+    "output",
+    [
+        "__import__('os').getcwd()",
+        "(1).__class__",
+        "9 ** 9 ** 9",
+        "((9 ** 99) ** 99) ** 99",
+        "1 << 10 ** 9",
+        "list(range(10 ** 6))",
+        "list(range(2 ** 64))",
+        "[x for x in range(3) for y in range(3)]",
+        "[y for x in range(3)]",
+    ],
+)
+def test_mbpp_values_are_only_evaluated_if_safe(output):
+    with pytest.raises(ValueError):
+        unit_tests(f"assert f(1) == {output}")
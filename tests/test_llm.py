@@ -1,12 +1,19 @@
 from typing import Callable
+import asyncio
+import threading
+import time
 import pytest
 import logging
+import timeout_decorator
 
 from pyllm.clients import Client
 from pyllm.utils.types import SamplingParams
-from pyllm.interfaces import CodeLLM
+from pyllm.interfaces import CodeGenerator, CodeLLM, SelfDebugLLM
 from pyllm.utils.types import Function
+from pyllm.utils.caching import CacheHandler
 from pyllm.utils.exceptions import TooManyRetries
+from pyllm.templates import PromptTemplate
+from pyllm.parsers import RegExParser
 
 
 class MockClient(Client):
@@ -65,3 +72,317 @@ def test_failed_unit_tests(caplog):
     assert "4" in caplog.text, "y1 not in error"
     assert "10" in caplog.text, "x2 not in error"
     assert "40" in caplog.text, "y2 not in error"
+
+
+def test_async_function_generation():
+    # A function that swaps two numbers
+    response = (
+        "<START-OF-CODE>\ndef swap_numbers(a, b):\n    return b, a\n<END-OF-CODE>"
+    )
+
+    llm = CodeLLM(client=MockClient(response))
+
+    function = asyncio.run(
+        llm.adef_function("", unit_tests=[((1, 4), (4, 1))], use_cached=False)
+    )
+
+    assert isinstance(function, Function)
+    assert function(1, 10) == (10, 1)
+
+
+@pytest.mark.parametrize("llm_class", [CodeLLM, SelfDebugLLM])
+def test_async_unit_tests_run_off_the_event_loop(llm_class):
+    response = "```python\ndef increment(x):\n    return x + 1\n```"
+    test_threads = []
+
+    class RecordingClient(MockClient):
+        def query(self, prompt=None, messages=None, sampling_params=None) -> str:
+            return self._response
+
+    class RecordingLLM(llm_class):
+        def unit_test(self, function, unit_tests, **kwargs):
+            test_threads.append(threading.current_thread())
+            return super().unit_test(function, unit_tests, **kwargs)
+
+    llm = RecordingLLM(client=RecordingClient(response))
+
+    async def define():
+        return threading.current_thread(), await llm.adef_function(
+            "increment", unit_tests=[(1, 2)], use_cached=False
+        )
+
+    loop_thread, function = asyncio.run(define())
+
+    assert function(1) == 2
+    assert test_threads and loop_thread not in test_threads
+
+
+@pytest.mark.parametrize("n_processes", [1, 2, None])
+def test_unit_tests_in_processes(n_processes):
+    source = (
+        "```python\n"
+        "def function(x):\n"
+        "    if x == 'hang':\n"
+        "        while True:\n"
+        "            pass\n"
+        "    return 1 / x\n"
+        "```"
+    )
+    parser = RegExParser()
+
+    # Workers parse the function again from its source
+    results = CodeGenerator.unit_test(
+        parser.parse_function(source),
+        [(1, 1.0), (0, None), ("hang", None), (2, 0.5), (4, 1.0)],
+        timeout_s=1,
+        use_signals=False,
+        n_processes=n_processes,
+        source=source,
+        parser=parser,
+    )
+
+    assert [result.id for result in results] == [0, 1, 2, 3, 4]
+    assert [bool(result.failed) for result in results] == [
+        False,
+        True,
+        True,
+        False,
+        True,
+    ]
+    assert isinstance(results[1].error, ZeroDivisionError)
+    assert results[2].error is not None
+    assert results[3].yhat == 0.5
+
+
+def test_unit_tests_without_source_run_on_threads():
+    def function(x):
+        if x == "slow":
+            time.sleep(2)
+        return 1 / x
+
+    results = CodeGenerator.unit_test(
+        function, [(1, 1.0), ("slow", None), (0, None)], timeout_s=1, use_signals=False
+    )
+
+    assert results[0].yhat == 1.0 and not results[0].failed
+    assert isinstance(results[1].error, timeout_decorator.TimeoutError)
+    assert isinstance(results[2].error, ZeroDivisionError)
+
+
+def test_concurrent_cached_generations_are_coalesced(tmp_path):
+    response = "```python\ndef increment(x):\n    return x + 1\n```"
+
+    class SlowClient(MockClient):
+        n_queries = 0
+
+        def query(self, input_string: str, sampling_params: SamplingParams) -> str:
+            self.n_queries += 1
+            time.sleep(0.2)
+            return self._response
+
+    client = SlowClient(response)
+    llm = CodeLLM(client=client)
+    llm.cache = CacheHandler(str(tmp_path / "functions.db"))
+
+    functions = []
+    threads = [
+        threading.Thread(target=lambda: functions.append(llm.def_function("increment")))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert client.n_queries == 1
+    assert [function(1) for function in functions] == [2, 2, 2, 2]
+
+
+def test_cache_is_shared_across_instances(tmp_path):
+    path = str(tmp_path / "functions.db")
+
+    assert CacheHandler.shared(path) is CacheHandler.shared(path)
+    assert CodeLLM(client=MockClient("")).cache is CodeLLM(client=MockClient("")).cache
+
+
+def test_multiple_function_generation():
+    response = "```python\ndef increment(x):\n    return x + 1\n```"
+    llm = CodeLLM(client=MockClient(response))
+
+    functions = llm.def_functions(
+        ["increment", "increment", "decrement"],
+        unit_tests=[[(1, 2)], None, [(1, 0)]],
+        use_cached=False,
+    )
+
+    assert functions[0](1) == 2
+    assert functions[1](1) == 2
+    assert isinstance(functions[2], TooManyRetries)
+
+
+def test_async_self_debug():
+    responses = iter(
+        "```python\ndef increment(x):\n    return x + %d\n```" % i for i in (0, 1, 1)
+    )
+
+    class DebuggedClient(MockClient):
+        def query(self, prompt=None, messages=None, sampling_params=None) -> str:
+            return next(responses)
+
+    llm = SelfDebugLLM(client=DebuggedClient(""))
+
+    function = asyncio.run(llm.adef_function("increment", [(1, 2)], max_turns=3))
+
+    assert function(1) == 2
+
+
+def test_unparseable_responses_are_fed_back():
+    class RecordingClient(MockClient):
+        def query(self, input_string: str, sampling_params: SamplingParams) -> str:
+            self.prompts.append(input_string)
+            return self._response
+
+    client = RecordingClient("I cannot write this function.")
+    client.prompts = []
+    llm = CodeLLM(client=client)
+
+    with pytest.raises(TooManyRetries):
+        llm.def_function("", use_cached=False, n_retries=5)
+
+    # The parsing error is fed back, and the repeated response ends the retries early
+    assert len(client.prompts) == 2
+    assert "could not be parsed" in client.prompts[1]
+
+
+def test_self_debug_draft_client():
+    class RecordingClient(MockClient):
+        def query(self, prompt=None, messages=None, sampling_params=None) -> str:
+            self.n_queries += 1
+            return self._response
+
+    client = RecordingClient("```python\ndef increment(x):\n    return x\n```")
+    draft_client = RecordingClient(
+        "```python\ndef increment(x):\n    return x + 1\n```"
+    )
+    client.n_queries = draft_client.n_queries = 0
+    llm = SelfDebugLLM(client=client, draft_client=draft_client)
+
+    function = llm.def_function("increment", [(1, 2)], max_turns=3)
+
+    # Only the first generation goes to the full model, while the fix and the
+    # confirmation of the fix go to the draft model
+    assert function(1) == 2
+    assert (client.n_queries, draft_client.n_queries) == (1, 2)
+
+
+def test_self_debug_returns_function_passing_on_last_turn():
+    responses = iter(
+        "```python\ndef increment(x):\n    return x + %d\n```" % i for i in (0, 1)
+    )
+
+    class DebuggedClient(MockClient):
+        def query(self, prompt=None, messages=None, sampling_params=None) -> str:
+            return next(responses)
+
+    llm = SelfDebugLLM(client=DebuggedClient(""))
+
+    # The turns run out before the fixed function can be confirmed
+    function = llm.def_function("increment", [(1, 2)], max_turns=2, n_retries=2)
+
+    assert function(1) == 2
+
+
+def test_function_parsing_is_linear_in_whitespace():
+    # Used to backtrack quadratically over the trailing whitespace
+    response = "```python\ndef identity(x):\n    return x\n" + " " * 100_000
+
+    function = CodeLLM(client=MockClient(response)).def_function("", use_cached=False)
+
+    assert function(1) == 1
+
+
+def test_streamed_response_stops_after_code_block():
+    class StreamingClient(MockClient):
+        def query_stream(self, input_string, sampling_params):
+            self.n_chunks = 0
+            for line in self._response.splitlines(keepends=True):
+                self.n_chunks += 1
+                yield line
+
+    response = "```python\ndef add(a, b):\n    return a + b\n```\nThis function adds two numbers.\nIt is very simple.\n"
+    client = StreamingClient(response)
+    llm = CodeLLM(client=client, stream=True)
+
+    function = llm.def_function("", use_cached=False)
+
+    assert function(1, 2) == 3
+    # The explanation after the code block is never read
+    assert client.n_chunks == 4
+
+
+def test_streamed_response_is_not_cut_at_def_in_prose():
+    class StreamingClient(MockClient):
+        def query_stream(self, input_string, sampling_params):
+            self.n_chunks = 0
+            for line in self._response.splitlines(keepends=True):
+                self.n_chunks += 1
+                yield line
+
+    response = "I'll use a plain def for this.\n```python\ndef add(a, b):\n    return a + b\n```\nThis function adds two numbers.\n"
+    client = StreamingClient(response)
+    llm = CodeLLM(client=client, stream=True)
+
+    function = llm.def_function("", use_cached=False)
+
+    # The stream is only cut once the code block is closed
+    assert function(1, 2) == 3
+    assert client.n_chunks == 5
+
+
+def test_code_only_response_is_parsed_whole():
+    # Top level statements other than imports and functions are not run
+    response = (
+        "import math\n\ndef root(x):\n    return math.sqrt(x)\n\nraise ValueError\n"
+    )
+
+    function = CodeLLM(client=MockClient(response)).def_function("", use_cached=False)
+
+    assert function(9) == 3
+
+
+def test_parsed_responses_do_not_share_globals():
+    from pyllm.parsers import RegExParser, regex_parser
+
+    parser = RegExParser()
+    parser.parse_function("import json\n\ndef helper():\n    return 1\n")
+    function = parser.parse_function("def caller():\n    return helper()\n")
+
+    assert "helper" not in vars(regex_parser)
+    with pytest.raises(NameError):
+        function()
+
+
+def test_prompt_template_reuses_renders_of_equal_arguments_only():
+    template = PromptTemplate("{{ prompt }}: {{ unit_tests }}")
+
+    assert template.apply("f", unit_tests=[(1, 2)]) == "f: [(1, 2)]"
+    assert template.apply("f", unit_tests=[(1, 2)]) == "f: [(1, 2)]"
+    # Equal values that render differently aren't mixed up
+    assert template.apply("f", unit_tests=[(1.0, 2)]) == "f: [(1.0, 2)]"
+    assert template.apply("f", unit_tests=[(True, 2)]) == "f: [(True, 2)]"
+    assert template.apply("f", unit_tests=[(0.0, 2)]) == "f: [(0.0, 2)]"
+    assert template.apply("f", unit_tests=[(-0.0, 2)]) == "f: [(-0.0, 2)]"
+    assert len(template._rendered) == 5
+
+    class Counter:
+        count = 0
+
+        def __repr__(self):
+            Counter.count += 1
+            return str(Counter.count)
+
+    # Arguments that can't be keyed by value are rendered every time
+    counter = Counter()
+    assert template.apply("f", unit_tests=[(counter, 2)]) == "f: [(1, 2)]"
+    assert template.apply("f", unit_tests=[(counter, 2)]) == "f: [(2, 2)]"
+    assert len(template._rendered) == 5